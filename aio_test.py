@@ -0,0 +1,93 @@
+#! /usr/bin/python
+
+# Copyright 2008 Fergal Daly <fergal@esatclear.ie>
+
+# This file is part of deep.py.
+#
+# deep.py is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation; either version 2.1 of the License.
+#
+# deep.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with deep.py; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import asyncio
+import concurrent.futures
+import unittest
+
+import deep as d
+import deep.aio
+
+async def records(items):
+  for item in items:
+    await asyncio.sleep(0)
+    yield item
+
+class AdiffTest(unittest.TestCase):
+  def runTest(self):
+    async def run():
+      turns = [0]
+      done = []
+      async def ticker():
+        while not done:
+          turns[0] += 1
+          await asyncio.sleep(0)
+
+      task = asyncio.ensure_future(ticker())
+      big = [[i, str(i)] for i in range(2000)]
+      found = await deep.aio.adiff(big, [[i, str(i)] for i in range(1999)] +
+                                   [[1999, "x"]], pause=100)
+      done.append(True)
+      await task
+      return (found, turns[0])
+
+    (found, turns) = asyncio.run(run())
+    self.assertEqual("x[1999][1]", found.render_path())
+    # about 4 pairs per element
+    self.assertTrue(turns >= 50, turns)
+
+    self.assertEqual(None, asyncio.run(deep.aio.adiff([1, [2]], [1, [2]])))
+
+    found = asyncio.run(deep.aio.adiff([{}], [d.IndexedElem("a", 1)],
+                                       on_error="collect"))
+    self.assertEqual(["x[0]['a']"],
+                     [diff.render_path() for diff in found.errors])
+
+class Counting(concurrent.futures.ThreadPoolExecutor):
+  submitted = 0
+
+  def submit(self, *args, **kwargs):
+    self.submitted += 1
+    return concurrent.futures.ThreadPoolExecutor.submit(self, *args, **kwargs)
+
+class AdiffStreamTest(unittest.TestCase):
+  def runTest(self):
+    items = [{"id": i, "lines": list(range(i % 7))} for i in range(50)]
+    template = {"id": d.InstanceOf(int),
+                "lines": d.ArrayValues(d.InRange(0, 3))}
+    executor = Counting(2)
+
+    async def run():
+      found = []
+      async for (n, diff) in deep.aio.adiff_stream(
+          records(items), template, pause=10, executor=executor,
+          offload=lambda item: len(item["lines"]) > 5):
+        found.append((n, diff.render_path()))
+      return found
+
+    try:
+      found = asyncio.run(run())
+    finally:
+      executor.shutdown()
+    self.assertEqual([(i, "x['lines'][4]") for i in range(50) if i % 7 >= 5],
+                     found)
+    self.assertEqual(7, executor.submitted)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -106,11 +106,56 @@ from builtins import object
 
 __author__ = "Fergal Daly <fergal@esatclear.ie>"
 
+import array
+import base64
+import builtins
+import collections
+import copy
+import datetime
+import decimal
+import fractions
+import hashlib
+import importlib
+import itertools
+import json
+import multiprocessing
+import multiprocessing.pool
 import re
+import struct
 import sys
+import time
 import traceback
 
+try:
+  import dataclasses
+except ImportError:
+  dataclasses = None
+
+try:
+  import reprlib
+except ImportError:
+  # python 2
+  import repr as reprlib
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
 __all__ = ['diff',
+           'matches',
+           'iter_diffs',
+           'register_wrapper',
+           'parallel_diff',
+           'validate_many',
+           'dump',
+           'dumps',
+           'load',
+           'loads',
+           'infer',
+           'Fingerprints',
+           'StatsComparison',
+           'Session',
            'Equal',
            'Is',
            'Type',
@@ -119,52 +164,455 @@ __all__ = ['diff',
            'List',
            'Tuple',
            'EqSet',
+           'Bag',
            'HasKeys',
            'Dict',
+           'Optional',
            'HasAttr',
            'Attr',
            'Attrs',
            'Call',
            'Object',
+           'Fields',
            'And',
            'Ignore',
            'Re',
            'Slice',
            'ArrayValues',
            'DictValues',
+           'Near',
+           'InRange',
+           'ArrayEqual',
+           'ArrayNear',
            ]
 
 DEBUG = 0
 
+class BoundedRepr(reprlib.Repr):
+  """A reprlib.Repr that keeps dicts in their own order."""
+  def repr_dict(self, x, level):
+    if not x:
+      return "{}"
+    if level <= 0:
+      return "{...}"
+
+    pieces = ["%s: %s" % (self.repr1(key, level - 1),
+                          self.repr1(x[key], level - 1))
+              for key in itertools.islice(x, self.maxdict)]
+    if len(x) > self.maxdict:
+      pieces.append("...")
+    return "{%s}" % ", ".join(pieces)
+
+# Values are rendered with this, so that rendering a difference in a big
+# structure is quick and the result is a manageable size. Change its limits
+# (see reprlib.Repr) to see more or less.
+REPR = BoundedRepr()
+REPR.maxlevel = 6
+REPR.maxlist = REPR.maxtuple = REPR.maxset = REPR.maxfrozenset = \
+  REPR.maxdeque = REPR.maxarray = REPR.maxdict = 30
+REPR.maxstring = REPR.maxlong = REPR.maxother = 200
+
 class Unspec(object): pass
 
+# Generated by Comparison.walk() when it pauses.
+class Pause(object): pass
+
 # Python3 does not have the unicode type.
 EQUAL_TYPES = (str, int, bool, float) + (
   () if sys.version_info[0] == 3 else (str,))
 
+# type: a function that takes an item of that type and returns its
+# comparator, see register_wrapper()
+WRAPPERS = {}
+# type: the wrapper found for it by find_wrapper()
+WRAPPER_CACHE = {}
+
+def register_wrapper(t, wrapper):
+  """Make Comparison.wrap() use wrapper(item) to build the comparator for
+  items of type t, and of its subclasses unless they have their own
+  wrapper. Anything without a wrapper is compared as an Object."""
+  WRAPPERS[t] = wrapper
+  WRAPPER_CACHE.clear()
+
+def find_wrapper(t):
+  """
+  Returns: the wrapper registered for t or the nearest of its base classes.
+    Classes that would be compared as an Object but have no __dict__ and
+    their own __eq__() are compared with Equal, unless they are dataclasses
+    or attrs classes. Other classes that would be compared as an Object or
+    a tuple but list their fields (see fields_of()) are compared with
+    Fields.
+  """
+  wrapper = WRAPPER_CACHE.get(t)
+  if wrapper is None:
+    for base in getattr(t, "__mro__", (t, object)):
+      wrapper = WRAPPERS.get(base)
+      if wrapper is not None:
+        break
+    if base is object and getattr(t, "__dictoffset__", 1) == 0 and \
+       t.__eq__ is not object.__eq__ and not declares_fields(t):
+      # e.g. a type written in C, or one that keeps caches in its __slots__,
+      # there's no __dict__ to compare and its __eq__() knows what matters
+      wrapper = Equal
+    elif base in (object, tuple) and fields_of(t) is not None:
+      wrapper = Fields
+    WRAPPER_CACHE[t] = wrapper
+
+  return wrapper
+
+# class: the names of its fields or None, see fields_of()
+FIELDS = {}
+
+def declares_fields(cls):
+  """
+  Returns: true if cls is a dataclass or an attrs class.
+  """
+  return dataclasses is not None and dataclasses.is_dataclass(cls) or \
+    hasattr(cls, "__attrs_attrs__")
 
-def diff(i1, i2, debug=Unspec):
+def fields_of(cls):
+  """
+  Returns: a tuple of the names of the fields of cls's instances, taken
+    from namedtuple's _fields, dataclass or attrs fields or __slots__, or
+    None for anything else. If instances of a class with __slots__ also
+    have a __dict__, "__dict__" is one of the fields.
+  """
+  if cls in FIELDS:
+    return FIELDS[cls]
+
+  fields = None
+  if issubclass(cls, tuple):
+    if isinstance(getattr(cls, "_fields", None), tuple):
+      fields = cls._fields
+  elif declares_fields(cls):
+    if hasattr(cls, "__attrs_attrs__"):
+      fields = tuple(a.name for a in cls.__attrs_attrs__
+                     if getattr(a, "eq", True))
+    else:
+      fields = tuple(f.name for f in dataclasses.fields(cls) if f.compare)
+  else:
+    slots = []
+    has_dict = False
+    # base classes first
+    for c in reversed(getattr(cls, "__mro__", (cls,))[:-1]):
+      if "__slots__" not in c.__dict__:
+        has_dict = True
+        continue
+      names = c.__dict__["__slots__"]
+      if isinstance(names, str):
+        names = (names,)
+      for name in names:
+        if name == "__dict__":
+          has_dict = True
+        elif name != "__weakref__":
+          if name.startswith("__") and not name.endswith("__"):
+            # private names are mangled
+            name = "_%s%s" % (c.__name__.lstrip("_"), name)
+          slots.append(name)
+    if slots:
+      fields = tuple(slots)
+      if has_dict:
+        fields += ("__dict__",)
+    elif not has_dict:
+      # e.g. a subclass of object that only sets __slots__ = ()
+      fields = ()
+
+  FIELDS[cls] = fields
+  return fields
+
+
+def diff(i1, i2, debug=Unspec, fingerprints=None, cache_size=None,
+         tolerance=None, on_error="raise"):
+  """Compare i1 against the template i2.
+
+  Arguments:
+    fingerprints: a Fingerprints object, identical plain subtrees are
+      skipped using their fingerprints, which are kept for later calls.
+    cache_size: the most results to keep in the Comparison's cache.
+    tolerance: a dict of keyword arguments for Near, e.g. {"atol": 0.01},
+      every float in the template is compared using Near with these.
+    on_error: what to do when a comparator raises an exception, see
+      Comparison.
+  Returns: None if they match or the Comparison that found a difference,
+    see outcome().
+  """
   if debug is Unspec:
     debug = DEBUG
   if debug:
-    comp = DebugComparison()
+    comp = DebugComparison(fingerprints, cache_size, tolerance, on_error)
   else:
-    comp = Comparison()
-  equal = comp.descend(i1, i2)
+    comp = Comparison(fingerprints, cache_size, tolerance, on_error)
+  return outcome(comp, comp.descend(i1, i2))
 
-  if equal:
-    return None
-  else:
+def outcome(comp, equal):
+  """
+  Returns: what diff() returns for comp, None if equal is true and no
+    exceptions were collected, otherwise comp. If equal is true, comp's
+    stack is set to the first of its errors, so that it renders that.
+  """
+  if not equal:
     return comp
+  elif comp.errors:
+    comp.stack[:] = comp.errors[0].stack
+    return comp
+  return None
+
+def iter_diffs(i1, i2, max_diffs=None, on_error="raise"):
+  """Like diff() but carries on past the first difference.
+
+  Arguments:
+    max_diffs: stop after this many differences.
+    on_error: see Comparison.
+  Returns: a generator of a Difference for each difference found and, with
+    on_error="collect", for each exception, in the order they were found.
+    The comparison only goes as far as is needed for the next one.
+  """
+  comp = Comparison(on_error=on_error)
+  errors = comp.errors
+  # the number of errors and of Differences generated
+  (done, n) = (0, 0)
+  for difference in itertools.chain(comp.differences(i1, i2), [None]):
+    found = errors[done:]
+    done = len(errors)
+    # a composite that had already failed is reported with the Raised
+    # comparator of its error too
+    if difference is not None and \
+       not (found and difference.last()[1] is found[-1].last()[1]):
+      found.append(difference)
+    for difference in found:
+      if max_diffs is not None and n >= max_diffs:
+        return
+      yield difference
+      n += 1
+
+def parallel_diff(i1, i2, workers=None, chunksize=1000):
+  """Like diff() but the elements of a top-level List, Tuple, Dict,
+  ArrayValues or DictValues are compared in a pool of worker processes.
+  Anything else at the top level is compared in this process, in order.
+  The elements and their templates are sent to the workers so they must
+  be picklable.
+
+  Arguments:
+    workers: the number of processes, defaults to the number of CPUs.
+    chunksize: the number of elements sent to a worker at a time.
+  Returns: None if they match or the Comparison that found a difference,
+    which is the same first difference that diff() finds.
+  """
+  comp = Comparison()
+  if not isinstance(i2, Comparator):
+    i2 = comp.wrap(i2)
+  if workers is None:
+    workers = multiprocessing.cpu_count()
+  if workers < 2 or kind_of(type(i2)) is not COMPOSITE:
+    return diff(i1, i2)
+
+  pool = multiprocessing.Pool(workers)
+  try:
+    # [(item, comparator), descents] for the comparators being expanded
+    frames = [[(i1, i2), i2.descents(i1)]]
+    # (parents, IndexedElem, element) waiting to be sent to the pool
+    pending = []
+    while frames:
+      pair = next(frames[-1][1], None)
+      if pair is None:
+        frames.pop()
+        continue
+
+      (item, comparator) = pair
+      if item is i1 and type(comparator) is Slice:
+        frames.append([pair, comparator.descents(item)])
+        continue
+
+      parents = [frame[0] for frame in frames]
+      if item is i1 and type(comparator) is IndexedElem:
+        try:
+          pending.append((parents, comparator, comparator.transform(item)))
+          continue
+        except Exception:
+          # let descend() explain it
+          pass
+
+      # the elements before this must be compared first
+      comp = diff_pending(pool, i1, pending, chunksize)
+      if comp:
+        return comp
+      pending = []
+
+      comp = Comparison()
+      comp.stack.extend(parents)
+      if not comp.descend(item, comparator):
+        return comp
+
+    return diff_pending(pool, i1, pending, chunksize)
+  finally:
+    pool.terminate()
+
+def diff_pending(pool, i1, pending, chunksize):
+  """Used by parallel_diff(), compares the pending elements of i1 in the
+  pool.
+
+  Returns: None if they all match or a Comparison for the first one that
+    doesn't.
+  """
+  chunks = ([(elem, comparator.value)
+             for (parents, comparator, elem) in pending[n:n + chunksize]]
+            for n in range(0, len(pending), chunksize))
+
+  for (n, found) in enumerate(pool.imap(diff_chunk, chunks)):
+    if found is not None:
+      # compare it again here to get the full stack
+      (parents, comparator, elem) = pending[n * chunksize + found]
+      comp = Comparison()
+      comp.stack.extend(parents)
+      comp.descend(i1, comparator)
+      return comp
+
+  return None
+
+def diff_chunk(chunk):
+  """Run by parallel_diff()'s workers.
+
+  Returns: the position of the first (item, template) in chunk that
+    doesn't match or None.
+  """
+  comp = Comparison()
+  for (n, (item, template)) in enumerate(chunk):
+    try:
+      if not comp.descend(item, template):
+        return n
+    except DeepException:
+      return n
+
+  return None
+
+def validate_many(items, template, workers=None, pool=None, tolerance=None,
+                  on_error="raise"):
+  """Compare each of items against template in a pool of threads. The
+  template is compiled once and shared by all of the threads.
+  Comparisons hold the GIL, so this helps when the items are being produced
+  concurrently, e.g. by requests being handled, or when comparators wait,
+  e.g. in Call, rather than for plain CPU bound comparisons, see
+  parallel_diff() for those.
+
+  Arguments:
+    workers: the number of threads, defaults to the number of CPUs.
+    pool: a multiprocessing.pool.ThreadPool to use instead of starting one.
+    tolerance, on_error: see diff().
+  Returns: a list with None or the Comparison that found a difference for
+    each item, in order.
+  """
+  template = compile(template, tolerance)
+  def validate(item):
+    return diff(item, template, on_error=on_error)
+
+  if pool is not None:
+    return pool.map(validate, items)
+
+  pool = multiprocessing.pool.ThreadPool(workers)
+  try:
+    return pool.map(validate, items)
+  finally:
+    pool.terminate()
+
+def matches(i1, i2, tolerance=None, on_error="raise"):
+  """Returns true if i1 matches i2. This is faster than diff() as it doesn't
+  keep track of where it is. If you need to know why i1 doesn't match, call
+  diff(). on_error can't be "collect", as there's nowhere to put the
+  errors."""
+  if on_error == "collect":
+    raise ValueError("matches() can't collect errors, use diff()")
+  try:
+    return MatchComparison(tolerance).descend(i1, i2)
+  except Exception:
+    # a comparator raised an exception, the full comparison can explain it
+    return not diff(i1, i2, tolerance=tolerance, on_error=on_error)
+
+def compile(template, tolerance=None):
+  """Turn template into a tree of comparators, wrapping all of the plain
+  data inside it and building the comparators that are normally built
+  during each comparison. The result can be used in place of template
+  for any number of comparisons, e.g. compile(template).diff(item), and
+  is not affected by later changes to template. tolerance is as for
+  diff(). It's not in __all__, as it would hide the builtin compile()."""
+  return Compiler(tolerance).run(template)
 
 class Comparator(object):
   """Base class for all Comparator objects."""
+  __slots__ = ()
+
+  # see Composite
+  descents = None
+  # see ArrayValues
+  mismatches = None
+
   def render_value(self, value):
-    return repr(value)
+    return REPR.repr(value)
 
   def expr(self, expr):
     return expr
 
+  def compile(self, compiler):
+    """Called on a copy of this comparator by Compiler. Override this
+    to replace any templates held by the comparator with their compiled
+    versions."""
+    pass
+
+  def arguments(self):
+    """Override this to return the arguments that build a copy of this
+    comparator, for dump()."""
+    raise TypeError("%s can't be dumped" % self.__class__.__name__)
+
+  def diff(self, item):
+    """Same as deep.diff(item, self)."""
+    return diff(item, self)
+
+  def matches(self, item):
+    """Same as deep.matches(item, self)."""
+    return matches(item, self)
+
+class Compiler(object):
+  """This object holds the state of a single call to compile(). The insides
+  of each comparator are compiled in a loop rather than by recursion, so
+  there's no limit on how deep the template can be."""
+  def __init__(self, tolerance=None):
+    self.comparison = Comparison(tolerance=tolerance)
+    self.compiled = {}
+    # the copies whose compile() hasn't been called yet
+    self.pending = []
+
+  def run(self, template):
+    """
+    Returns: the compiled template.
+    """
+    compiled = self.compile(template)
+    pending = self.pending
+    while pending:
+      pending.pop().compile(self)
+
+    return compiled
+
+  def compile(self, item):
+    """
+    Returns: a copy of the comparator for item. Everything inside it is
+      compiled by run() later, so a comparator's compile() must only keep
+      the results. Items seen before return the same copy so shared and
+      circular templates stay shared and circular.
+    """
+    key = id(item)
+    if key in self.compiled:
+      return self.compiled[key][1]
+
+    if isinstance(item, Comparator):
+      comparator = item
+    else:
+      comparator = self.comparison.wrap(item)
+    compiled = copy.copy(comparator)
+    # keep item alive so that its id can't be reused
+    self.compiled[key] = (item, compiled)
+    self.pending.append(compiled)
+
+    return compiled
+
 class DeepException(Exception):
   """Exception class, shouldn't ever be used but keeps a stack trace
   to make debugging easier."""
@@ -182,93 +630,232 @@ class DeepException(Exception):
       "".join(traceback.format_exception(*(self.einfo)))
       )
 
-class Comparison(object):
-  """This object holds all the state of a single comparison."""
-  def __init__(self):
-    self.cache = {}
-    self.stack = []
-
-  def debug(self, msg):
-    pass
-
-  def descend(self, i1, i2):
+class Fingerprints(object):
+  """Structural fingerprints of plain data, that is builtin containers of
+  builtin scalars. Two items with the same fingerprint are equal, so a
+  comparison can skip them without looking inside. Fingerprints are kept for
+  every container seen, so the same object can be used for several
+  comparisons of the same data. If a container in that data changes, call
+  forget() with it, or clear()."""
+  def __init__(self, maxsize=None):
     """
     Arguments:
-      i1 : any item of data
-      i2 : an item to compare with i1, this may be some plain data, an
-        object derived from deep.Comparator or a mix of both.
-    Returns: A true or false value
-
-    Operation:
-      1 Return true if i1 and i2 are the same object (using id()).
-      2 If we have compared i1 and i2 before we return the value we
-        returned previously, from a cache.
-      3 If i2 is not already derived from deep.Comparator, wrap it in an
-        appropriate comarator object and call that i2.
-      4 Ask the comparator i2 if it considers i1 to be equal.
-
-    Circular structures are handled by stage 2 above and the fact that
-    when we encounter a previously unseen pair (i1, i2) we set their cached
-    result to true. This is effectively "assume i1 == i2 unless we can prove
-    otherwise". Eventually we will come back out of the circular structure
-    and if we couldn't find an differences then it really was true.
+      maxsize: the most fingerprints to keep. When there are more, the
+        oldest are forgotten, along with those of the containers they're
+        inside.
+    """
+    self.maxsize = maxsize
+    # id: (item, fingerprint, the ids of the containers inside item), oldest
+    # first
+    self.prints = collections.OrderedDict()
+    # id: the ids of the containers whose fingerprints include it
+    self.parents = {}
+    self.active = set()
+
+  def get(self, item):
     """
+    Returns: the fingerprint of item or None if it's not plain data
+      or it's not a container.
+    """
+    if type(item) not in FINGERPRINT_TYPES:
+      return None
 
-    if i1 is i2:
-      return True
+    entry = self.prints.get(id(item))
+    if entry is not None:
+      return entry[1]
 
-    if not isinstance(i2, Comparator):
-      i2 = self.wrap(i2)
+    try:
+      fingerprint = self.fingerprint(item)
+    except RuntimeError:
+      # too deep for the recursion limit, it's compared as usual
+      fingerprint = None
 
-    # We don't know whether i1 will be hashable so take it's id
-    # Comparators are not hashable so this will be just id()
-    key = (id(i1), i2) 
-    cache = self.cache
-    if key in cache:
-      equals = cache[key]
-    else:
-      cache[key] = True # assume true to match circular structures
-      stack = self.stack
-      stack.append((i1, i2))
-      equals = False
-      try:
-        try:
-          equals = i2.equals(i1, self)
-        finally:
-          cache[key] = equals
-      except DeepException:
-        raise
-      except Exception:
-        raise DeepException(self)
-
-      if equals:
-        stack.pop()
-      
-    return equals
+    if self.maxsize is not None:
+      prints = self.prints
+      while len(prints) > self.maxsize:
+        self.drop(next(iter(prints)))
 
-  def wrap(self, item):
-    """Take a python object and return a deep.Comparator object that
-    will make the "right" type of comparison"""
+    return fingerprint
+
+  def fingerprint(self, item):
     t = type(item)
 
-    # do I cover all the builtin types here?
-    # missing Class
     if t in EQUAL_TYPES:
-      return Equal(item)
-    elif t in (list, ):
-      return List(item)
-    elif t in (set, ):
-      return Set(item)
-    elif t in (frozenset, ):
-      return Frozenset(item)
-    elif t in (tuple, ):
-      return Tuple(item)
-    elif t in (dict, ):
-      return Dict(item)
-    elif t in (type, ):
-      return Is(item)
+      if item != item:
+        # nan doesn't equal itself
+        return None
+      elif t is int:
+        value = hex(item)
+      else:
+        value = repr(item)
+      return hashlib.sha1(("%s:%s" % (t.__name__, value)).encode("utf-8")
+                          ).digest()
+    elif item is None:
+      return b"None"
+    elif t not in FINGERPRINT_TYPES:
+      return None
+
+    key = id(item)
+    entry = self.prints.get(key)
+    if entry is not None:
+      return entry[1]
+    elif key in self.active:
+      # circular
+      return None
+
+    self.active.add(key)
+    # the containers inside item
+    children = []
+    try:
+      if t is dict:
+        parts = []
+        for (k, v) in item.items():
+          kp = self.fingerprint(k)
+          vp = self.fingerprint(v)
+          children.extend(c for c in (k, v) if type(c) in FINGERPRINT_TYPES)
+          if kp is None or vp is None:
+            parts = None
+            break
+          parts.append(kp + vp)
+      else:
+        parts = []
+        for i in item:
+          p = self.fingerprint(i)
+          if type(i) in FINGERPRINT_TYPES:
+            children.append(i)
+          if p is None:
+            parts = None
+            break
+          parts.append(p)
+
+      if parts is None:
+        fingerprint = None
+      else:
+        if t is not list and t is not tuple:
+          # order doesn't matter
+          parts.sort()
+        h = hashlib.sha1(t.__name__.encode("utf-8"))
+        for part in parts:
+          h.update(part)
+        fingerprint = h.digest()
+    except RuntimeError:
+      # too deep, don't try again for the containers around this one
+      self.prints[key] = (item, None, set())
+      raise
+    finally:
+      self.active.discard(key)
+
+    children = set(map(id, children))
+    for child in children:
+      self.parents.setdefault(child, set()).add(key)
+    # keep item alive so that its id can't be reused
+    self.prints[key] = (item, fingerprint, children)
+
+    return fingerprint
+
+  def forget(self, item):
+    """Forget the fingerprint of item, which has changed, and of every
+    container it's inside, but not of anything inside it."""
+    self.drop(id(item))
+
+  def drop(self, key):
+    """Forget the fingerprint of the item with id key and of every container
+    it's inside."""
+    prints = self.prints
+    parents = self.parents
+    keys = [key]
+    while keys:
+      key = keys.pop()
+      entry = prints.pop(key, None)
+      if entry is not None:
+        for child in entry[2]:
+          above = parents.get(child)
+          if above is not None:
+            above.discard(key)
+            if not above:
+              del parents[child]
+      keys.extend(parents.pop(key, ()))
+
+  def clear(self):
+    self.prints.clear()
+    self.parents.clear()
+
+FINGERPRINT_TYPES = (list, tuple, dict, set, frozenset)
+
+class Cache(object):
+  """The results of comparing pairs of (item, comparator), so that circular
+  structures can be handled and shared ones only compared once.
+
+  Pairs being compared are assumed to match until we find out otherwise.
+  The items in the cache are kept alive, so their ids can't be reused while
+  they are cached. If maxsize is given, the oldest results are forgotten
+  to keep at most maxsize of them, the pairs still being compared are kept
+  as well.
+  """
+  def __init__(self, maxsize=None):
+    self.maxsize = maxsize
+    # key: result, result is None while the pair is being compared
+    self.entries = {}
+    if maxsize is None:
+      # nothing is forgotten so a list is enough to keep the items alive
+      self.items = []
     else:
-      return Object(item)
+      # key: item
+      self.items = {}
+      # the keys with results, oldest first
+      self.order = collections.deque()
+    self.hits = 0
+    self.misses = 0
+
+  def add(self, key, item):
+    """Start comparing a pair, only used when the cache is bounded."""
+    self.entries[key] = None
+    self.items[key] = item
+
+  def finish(self, key, result):
+    """Record the result of a pair, only used when the cache is bounded."""
+    entries = self.entries
+    entries[key] = result
+    order = self.order
+    order.append(key)
+    if len(order) > self.maxsize:
+      old = order.popleft()
+      # it may have been forgotten and started again
+      if entries.get(old) is not None:
+        del entries[old]
+        del self.items[old]
+
+  def set(self, key, result):
+    """Record the result of a pair."""
+    if self.maxsize is None:
+      self.entries[key] = result
+    else:
+      self.finish(key, result)
+
+  def __len__(self):
+    return len(self.entries)
+
+  def stats(self):
+    """
+    Returns: a dict with the size of the cache and the number of hits and
+      misses.
+    """
+    return {"size": len(self), "hits": self.hits, "misses": self.misses}
+
+# The values of Comparison's on_error
+ON_ERROR = ("raise", "mismatch", "collect")
+
+# Comparisons with items of these types aren't cached as they can't be part of
+# a circular structure, nor are templates of these types wrapped only once.
+UNCACHED_TYPES = frozenset(EQUAL_TYPES + (type(None), bytes, complex))
+
+class Difference(object):
+  """A difference found by a comparison, the stack holds the (item,
+  comparator) pairs that lead to it."""
+  __slots__ = ("stack",)
+
+  def __init__(self, stack):
+    self.stack = stack
 
   def render_path(self):
     """
@@ -311,18 +898,352 @@ class Comparison(object):
   def print_full(self):
     print(self.render_full())
 
+class Comparison(Difference):
+  """This object holds all the state of a single comparison. After a
+  failed comparison it also describes the first difference."""
+  # If true, every pair is passed to descend() rather than being handled in
+  # a loop.
+  recursive = False
+  tolerance = None
+  on_error = "raise"
+
+  def __init__(self, fingerprints=None, cache_size=None, tolerance=None,
+               on_error="raise"):
+    """
+    Arguments:
+      fingerprints: see Fingerprints
+      cache_size: the most results to keep in the cache, see Cache
+      tolerance: see diff()
+      on_error: what to do when a comparator raises an exception. "raise"
+        raises a DeepException. "mismatch" makes it a difference, the
+        comparator is replaced by a Raised comparator which renders the
+        exception. "collect" treats it as a match but adds a Difference
+        like that to the errors list.
+    """
+    if on_error not in ON_ERROR:
+      raise ValueError("on_error must be one of %s, not %r" %
+                       (", ".join(ON_ERROR), on_error))
+    self.cache = Cache(cache_size)
+    # id(template): comparator
+    self.wrapped = {}
+    # keeps the templates alive so their ids can't be reused
+    self.templates = []
+    self.stack = []
+    self.fingerprints = fingerprints
+    self.tolerance = tolerance
+    self.on_error = on_error
+    # Differences for the exceptions collected
+    self.errors = []
+
+  def debug(self, msg):
+    pass
+
+  def descend(self, i1, i2):
+    """
+    Arguments:
+      i1 : any item of data
+      i2 : an item to compare with i1, this may be some plain data, an
+        object derived from deep.Comparator or a mix of both.
+    Returns: A true or false value
+
+    Operation:
+      1 Return true if i1 and i2 are the same object (using id()).
+      2 If we have compared i1 and i2 before we return the value we
+        returned previously, from a cache.
+      3 If i2 is not already derived from deep.Comparator, wrap it in an
+        appropriate comarator object and call that i2.
+      4 Ask the comparator i2 if it considers i1 to be equal.
+
+    Circular structures are handled by stage 2 above and the fact that
+    when we encounter a previously unseen pair (i1, i2) we set their cached
+    result to true. This is effectively "assume i1 == i2 unless we can prove
+    otherwise". Eventually we will come back out of the circular structure
+    and if we couldn't find an differences then it really was true.
+
+    Stage 4 doesn't recurse for Composite comparators, see walk().
+    """
+    for difference in self.walk(i1, i2):
+      return False
+
+    return True
+
+  def differences(self, i1, i2):
+    """Like descend() but carries on past the first difference.
+
+    Returns: a generator of a Difference for each difference found.
+    """
+    return self.walk(i1, i2, True)
+
+  def walk(self, i1, i2, every=False, pause=None):
+    """The loop behind descend() and differences(). The pairs generated by
+    Composite comparators are handled in a loop, keeping the comparators in
+    progress on an explicit stack of frames, so there's no limit on how deep
+    the structures can be.
+
+    Arguments:
+      pause: if set, Pause is generated after this many pairs have been
+        compared, and again after each further pause pairs, so that the
+        caller can do something else before carrying on, see deep.aio.
+    Generates: a Difference for each difference found or, if every is
+      false, None for the first difference, leaving the stack pointing at it.
+    """
+    stack = self.stack
+    cache = self.cache
+    entries = cache.entries
+    items = cache.items
+    bounded = cache.maxsize is not None
+    wrapped = self.wrapped
+    templates = self.templates
+    prints = self.fingerprints
+    recursive = self.recursive
+    # [key, steps, failed, depth] for each composite comparator in progress,
+    # key is None if the result is not cached, depth is the length of the
+    # stack with the comparator on it
+    frames = []
+    key = None
+    hits = 0
+    misses = 0
+    countdown = pause
+
+    # The loop is only restarted after a comparator raises an exception, see
+    # caught().
+
+    try:
+      while True:
+        try:
+          while True:
+            equals = None
+            # a failure inside a composite has already been reported
+            reported = False
+            if i1 is i2:
+              equals = True
+            else:
+              if not isinstance(i2, Comparator):
+                if prints is not None:
+                  p1 = prints.get(i1)
+                  if p1 is not None and p1 == prints.get(i2):
+                    equals = True
+
+                if equals is None:
+                  # inlined comparator()
+                  if type(i2) in UNCACHED_TYPES:
+                    i2 = self.wrap(i2)
+                  else:
+                    # wrap each part of the template once, so that the cache
+                    # can recognise it when it comes around again
+                    w = wrapped.get(id(i2))
+                    if w is None:
+                      w = wrapped[id(i2)] = self.wrap(i2)
+                      templates.append(i2)
+                    i2 = w
+
+              if equals is None:
+                # Only things that can be part of a circular structure are cached
+                # We don't know whether i1 will be hashable so take it's id
+                # Comparators are not hashable so this will be just id()
+                if type(i1) in UNCACHED_TYPES:
+                  key = None
+                else:
+                  key = (id(i1), i2)
+                  equals = entries.get(key, Unspec)
+                  if equals is False and every:
+                    # compare it again to report the differences inside it
+                    equals = Unspec
+
+                if key is not None and equals is not Unspec:
+                  hits += 1
+                  if equals is None:
+                    # assume true to match circular structures
+                    equals = True
+                  elif not equals:
+                    stack.append((i1, i2))
+                else:
+                  equals = None
+                  if countdown is not None:
+                    countdown -= 1
+                    if not countdown:
+                      countdown = pause
+                      yield Pause
+                  if key is not None:
+                    misses += 1
+                    if bounded:
+                      cache.add(key, i1)
+                    else:
+                      entries[key] = None
+                      # keep i1 alive so that its id can't be reused
+                      items.append(i1)
+                  stack.append((i1, i2))
+                  kind = KINDS.get(type(i2))
+                  if kind is None:
+                    kind = kind_of(type(i2))
+                  if recursive or kind is LEAF:
+                    # e.g. numpy's == gives numpy.bool_
+                    equals = bool(i2.equals(i1, self))
+                    if key is not None:
+                      if bounded:
+                        cache.finish(key, equals)
+                      else:
+                        entries[key] = equals
+                    if equals:
+                      stack.pop()
+                  elif kind is TRANSFORM:
+                    # one step, no need for a generator
+                    frames.append([key, None, False, len(stack)])
+                    (i1, i2) = (i2.transform(i1), i2.value)
+                    continue
+                  else:
+                    frames.append([key, i2.descents(i1), False, len(stack)])
+
+            # Pass the result to the composite comparators in progress, until
+            # one of them generates a new pair to look at.
+            while True:
+              if equals is False:
+                if not every:
+                  # the first difference fails every comparator in progress
+                  for frame in frames:
+                    if frame[0] is not None:
+                      cache.set(frame[0], False)
+                  frames = []
+                  yield None
+                  return
+
+                if not reported:
+                  yield Difference(stack[:])
+                stack.pop()
+
+              if not frames:
+                return
+
+              frame = frames[-1]
+              steps = frame[1]
+              pair = None
+              if equals is False:
+                frame[2] = True
+                if steps is not None:
+                  try:
+                    pair = steps.send(False)
+                  except StopIteration:
+                    pass
+              elif steps is not None:
+                pair = next(steps, None)
+
+              if pair is not None:
+                (i1, i2) = pair
+                break
+
+              frames.pop()
+              equals = not frame[2]
+              if frame[0] is not None:
+                if bounded:
+                  cache.finish(frame[0], equals)
+                else:
+                  entries[frame[0]] = equals
+              if equals:
+                stack.pop()
+              else:
+                reported = True
+        except DeepException:
+          raise
+        except Exception as error:
+          (i1, i2) = self.caught(error, frames, key)
+    finally:
+      for frame in frames:
+        if frame[0] is not None:
+          cache.set(frame[0], False)
+      cache.hits += hits
+      cache.misses += misses
+
+  def caught(self, error, frames, key):
+    """Called by walk() when a comparator raises an exception, e.g. a
+    KeyError from IndexedElem. Unless on_error is "raise", the pair being
+    compared, or the composite whose descents() raised, is replaced on the
+    stack by a Raised comparator.
+
+    Returns: the pair for walk() to compare next, which fails or, when
+      collecting, matches.
+    """
+    stack = self.stack
+    if self.on_error == "raise" or not stack:
+      raise DeepException(self)
+
+    failed = False
+    if frames and frames[-1][3] == len(stack):
+      frame = frames.pop()
+      (key, failed) = (frame[0], frame[2])
+    if key is not None:
+      self.cache.set(key, False)
+    # don't keep the frames of the traceback alive
+    error.__traceback__ = None
+
+    (item, comparator) = stack.pop()
+    raised = Raised(comparator, error)
+    if self.on_error == "collect":
+      self.errors.append(Difference(stack + [(item, raised)]))
+      if not failed:
+        return (item, item)
+
+    return (item, raised)
+
+  def probe(self, i1, i2):
+    """Like descend() but leaves no trace in the stack, for comparators that
+    try out several possibilities."""
+    depth = len(self.stack)
+    try:
+      return self.descend(i1, i2)
+    finally:
+      del self.stack[depth:]
+
+  def explain(self, item, comparator):
+    """Called by a comparator that has found a difference in item, to put
+    comparator, which describes it, in its place on the stack. Comparators
+    keep nothing about a comparison themselves, so a template can be shared
+    by any number of comparisons at once."""
+    self.stack[-1] = (item, comparator)
+
+  def comparator(self, item):
+    """
+    Returns: item if it's a comparator or the comparator that wraps it,
+      which is the same each time for the same template.
+    """
+    if isinstance(item, Comparator):
+      return item
+    elif type(item) in UNCACHED_TYPES:
+      return self.wrap(item)
+
+    w = self.wrapped.get(id(item))
+    if w is None:
+      w = self.wrapped[id(item)] = self.wrap(item)
+      self.templates.append(item)
+    return w
+
+  def wrap(self, item):
+    """Take a python object and return a deep.Comparator object that
+    will make the "right" type of comparison"""
+    t = type(item)
+
+    if t is float and self.tolerance is not None:
+      return Near(item, **self.tolerance)
+
+    wrapper = WRAPPER_CACHE.get(t)
+    if wrapper is None:
+      wrapper = find_wrapper(t)
+    return wrapper(item)
+
 class DebugComparison(Comparison):
   """This class is useful if you are debugging a comparison and would like
   output on the progress that is being made at each step."""
-  def __init__(self):
+  recursive = True
+
+  def __init__(self, fingerprints=None, cache_size=None, tolerance=None,
+               on_error="raise"):
     self.depth = 0
-    Comparison.__init__(self)
+    Comparison.__init__(self, fingerprints, cache_size, tolerance, on_error)
 
   def debug(self, msg):
     print("%s%s" % ("  " * self.depth, msg))
 
   def descend(self, i1, i2):
-    self.debug("descend(%s, %s)" % (i1, i2))
+    self.debug("descend(%s, %s)" % (REPR.repr(i1), REPR.repr(i2)))
     self.depth += 1
     res = super(DebugComparison, self).descend(i1, i2)
     self.depth -= 1
@@ -331,53 +1252,400 @@ class DebugComparison(Comparison):
 
   def wrap(self, item):
     wrapped = super(DebugComparison, self).wrap(item)
-    self.debug("%s wrapped as %s" % (repr(item), repr(wrapped)))
+    self.debug("%s wrapped as %s" % (REPR.repr(item), REPR.repr(wrapped)))
     return wrapped
 
+try:
+  timer = time.perf_counter
+except AttributeError:
+  # python 2
+  timer = time.time
+
+class StatsComparison(Comparison):
+  """A comparison that records how many times each class of comparator and
+  each path in the template was compared and how long that took. Elements
+  compared by ArrayValues and DictValues share a path, e.g. x[*]['id'].
+  Like DebugComparison, it recurses so it is limited by python's recursion
+  limit.
+
+    comp = StatsComparison()
+    comp.descend(item, template)
+    comp.print_summary()
+  """
+  recursive = True
+
+  def __init__(self, fingerprints=None, cache_size=None, tolerance=None,
+               on_error="raise"):
+    Comparison.__init__(self, fingerprints, cache_size, tolerance, on_error)
+    # class name: [count, total time, own time], own time excludes the time
+    # spent comparing the items inside
+    self.classes = {}
+    # path: [count, total time, own time]
+    self.paths = {}
+    self.max_depth = 0
+    # (path, comparator, time spent inside) for each comparison in progress
+    self.frames = [("x", None, 0.0)]
+
+  def descend(self, i1, i2):
+    if i1 is i2:
+      return Comparison.descend(self, i1, i2)
+
+    i2 = self.comparator(i2)
+    frames = self.frames
+    (parent, parent_comparator, inside) = frames[-1]
+    if type(parent_comparator) is Slice:
+      path = "%s[*]" % parent
+    else:
+      path = i2.expr(parent)
+    frames.append((path, i2, 0.0))
+    self.max_depth = max(self.max_depth, len(frames) - 1)
+
+    start = timer()
+    try:
+      return Comparison.descend(self, i1, i2)
+    finally:
+      taken = timer() - start
+      own = taken - frames.pop()[2]
+      (parent, parent_comparator, inside) = frames[-1]
+      frames[-1] = (parent, parent_comparator, inside + taken)
+      for (table, key) in ((self.classes, type(i2).__name__),
+                           (self.paths, path)):
+        entry = table.get(key)
+        if entry is None:
+          entry = table[key] = [0, 0.0, 0.0]
+        entry[0] += 1
+        entry[2] += own
+        # guards and transforms have the same path as their parent, which
+        # already counts them in its total
+        if key is not path or path != parent or parent_comparator is None:
+          entry[1] += taken
+
+  def summary(self, limit=10):
+    """
+    Returns: a report of the totals, the classes and the paths with the
+      most own time, at most limit of each.
+    """
+    cache = self.cache
+    lookups = cache.hits + cache.misses
+    lines = [
+      "comparisons: %i, time: %.6fs, max depth: %i, cache hits: %i/%i" % (
+        sum(entry[0] for entry in self.classes.values()),
+        self.frames[0][2], self.max_depth, cache.hits, lookups),
+      ]
+    for (title, table) in (("class", self.classes), ("path", self.paths)):
+      lines.append("%10s %12s %12s  %s" % ("count", "total", "own", title))
+      entries = sorted(table.items(), key=lambda entry: -entry[1][2])
+      for (key, (count, total, own)) in entries[:limit]:
+        lines.append("%10i %11.6fs %11.6fs  %s" % (count, total, own, key))
+
+    return "\n".join(lines)
+
+  def print_summary(self, limit=10):
+    print(self.summary(limit))
+
+class Session(Comparison):
+  """A comparison that can be repeated after the item has changed, only
+  comparing the parts of it that might have. The result of each element and
+  attribute compared is kept by its path, a tuple of the keys, indices and
+  attribute names that lead to it from the item.
+
+    session = Session(state, template)
+    found = session.check()
+    state["users"][3]["name"] = "Bob"
+    found = session.update([("users", 3, "name")])
+
+  The insides of anything compared by a comparator that doesn't step to an
+  element or attribute, e.g. the elements compared by an EqSet, have no
+  paths so they are compared every time. Like StatsComparison, it recurses
+  so it is limited by python's recursion limit.
+  """
+  recursive = True
+
+  def __init__(self, item, template, tolerance=None, on_error="raise"):
+    """
+    Arguments:
+      tolerance, on_error: see diff(), except that on_error can't be
+        "collect", as the results kept for a path don't have its errors.
+    """
+    if on_error == "collect":
+      raise ValueError("Session can't collect errors")
+    Comparison.__init__(self, tolerance=tolerance, on_error=on_error)
+    self.item = item
+    self.template = compile(template, tolerance)
+    # [{(type, id(value)): (equals, stack)}, {step: node}] for each path,
+    # the results of the comparators that step to the path and the nodes of
+    # the paths inside it
+    self.results = [{}, {}]
+    # the nodes of the paths being compared
+    self.nodes = [self.results]
+    # while non-zero, the pairs being compared have no paths
+    self.blind = 0
+
+  def check(self):
+    """Compare the item, reusing the results kept for the paths that
+    haven't changed since the last check.
+
+    Returns: None if it matches or this Session, describing the first
+      difference.
+    """
+    self.cache = Cache()
+    self.stack = []
+    if self.descend(self.item, self.template):
+      return None
+    else:
+      return self
+
+  def update(self, changed):
+    """Forget the results for the changed paths, everything inside them and
+    everything they're inside and check() again.
+
+    Arguments:
+      changed: the paths that have been set, added or deleted since the last
+        check, e.g. [("users", 3, "name")]. If the elements of a list have
+        been inserted or removed, the path of the list.
+    """
+    for path in changed:
+      node = self.results
+      for step in path:
+        node[0].clear()
+        node = node[1].get(step)
+        if node is None:
+          break
+      else:
+        node[0].clear()
+        node[1].clear()
+
+    return self.check()
+
+  def descend(self, i1, i2):
+    if i1 is i2 or self.blind:
+      return Comparison.descend(self, i1, i2)
+
+    i2 = self.comparator(i2)
+    if isinstance(i2, IndexedElem):
+      step = i2.index
+    elif isinstance(i2, (CmpAttr, HasAttr)) and i2.attr != "__dict__":
+      step = i2.attr
+    elif kind_of(type(i2)) is COMPOSITE or \
+         isinstance(i2, (CmpAttr, HasAttr, Optional)):
+      # compares item itself, or its __dict__ which has the same paths
+      return Comparison.descend(self, i1, i2)
+    else:
+      self.blind += 1
+      try:
+        return Comparison.descend(self, i1, i2)
+      finally:
+        self.blind -= 1
+
+    stack = self.stack
+    children = self.nodes[-1][1]
+    node = children.get(step)
+    if node is None:
+      node = children[step] = [{}, {}]
+    key = (type(i2), id(i2.value))
+    result = node[0].get(key)
+    if result is not None:
+      (equals, tail) = result
+      if not equals:
+        stack.extend(tail)
+      return equals
+
+    depth = len(stack)
+    self.nodes.append(node)
+    try:
+      equals = Comparison.descend(self, i1, i2)
+    finally:
+      self.nodes.pop()
+    node[0][key] = (equals, None if equals else stack[depth:])
+
+    return equals
+
+class MatchComparison(Comparison):
+  """A comparison that can only say yes or no. It skips the stack and the
+  exception handling of Comparison, so it can't render anything. It keeps
+  the result for each pair of containers it has compared, so data with
+  shared parts is only compared once. Below max_depth levels it compares
+  with a Comparison, which copes with circular and very deep data."""
+  max_depth = 100
+
+  def __init__(self, tolerance=None):
+    self.depth = 0
+    self.tolerance = tolerance
+    # (id(i1), id(i2)): (equals, i1, i2) for the finished pairs, keeping
+    # them alive so that their ids can't be reused
+    self.seen = {}
+
+  def descend(self, i1, i2):
+    if i1 is i2:
+      return True
+
+    if type(i1) in UNCACHED_TYPES:
+      key = None
+    else:
+      key = (id(i1), id(i2))
+      result = self.seen.get(key)
+      if result is not None:
+        return result[0]
+
+    template = i2
+    if not isinstance(i2, Comparator):
+      i2 = self.wrap(i2)
+
+    depth = self.depth
+    if depth >= self.max_depth:
+      # no recursion and it knows the pairs in progress
+      equals = Comparison(tolerance=self.tolerance).descend(i1, i2)
+    else:
+      self.depth = depth + 1
+      equals = i2.equals(i1, self)
+      self.depth = depth
+
+    if key is not None:
+      self.seen[key] = (equals, i1, template)
+    return equals
+
+  def probe(self, i1, i2):
+    return self.descend(i1, i2)
+
+  def explain(self, item, comparator):
+    pass
+
 class ValueComparator(Comparator):
   """A base class for comparators that perform a simple comparison
   against a value."""
+  __slots__ = ("value",)
+
   def __init__(self, value):
     self.value = value
 
   def render(self):
     return self.render_value(self.value)
 
+  def arguments(self):
+    return (self.value,)
+
   def __repr__(self):
     return "%s(%s)" % (self.__class__.__name__, repr(self.value))
 
-class TransformComparator(ValueComparator):
+class Composite(Comparator):
+  """A base class for comparators that compare item by comparing it, or
+  parts of it, against other comparators. Subclasses implement descents()
+  instead of equals()."""
+  __slots__ = ()
+
+  def equals(self, item, comp):
+    for (i1, i2) in self.descents(item):
+      if not comp.descend(i1, i2):
+        return False
+
+    return True
+
+  def descents(self, item):
+    """Override this method to generate the (item, comparator) pairs that
+    must all match. If a pair doesn't match, False may be sent back in,
+    otherwise the result of yield is None."""
+    return iter(())
+
+# How descend() handles each class of comparator.
+LEAF = "leaf"
+COMPOSITE = "composite"
+TRANSFORM = "transform"
+KINDS = {}
+
+def kind_of(cls):
+  """Work out and remember how descend() should handle comparators of class
+  cls. Only comparators that implement descents() and not equals() can be
+  handled without recursion."""
+  if cls.equals is not Composite.equals:
+    kind = LEAF
+  elif cls.descents is TransformComparator.descents:
+    kind = TRANSFORM
+  else:
+    kind = COMPOSITE
+  KINDS[cls] = kind
+  return kind
+
+class TransformComparator(ValueComparator, Composite):
   """A base class for comparators that transform their inout and then
   perform a simple comparison against a value."""
-  def equals(self, item, comp):
-    trans = self.transform(item)
-    return comp.descend(trans, self.value)
+  __slots__ = ()
+
+  def descents(self, item):
+    yield (self.transform(item), self.value)
 
   def transform(self, item):
     """Override this method with the transformation that should be applied."""
     pass
 
+  def compile(self, compiler):
+    self.value = compiler.compile(self.value)
+
   def trans_args(self):
     return ""
 
   def __repr__(self):
     return "%s(%s)==%s" %(self.__class__.__name__, self.trans_args(), repr(self.value))
 
+class Conjunction(Composite):
+  """A base class for comparators that check that item matches each of a
+  series of other comparators."""
+  __slots__ = ()
+
+  # the compiled conditions, subclasses with __slots__ must set this to None
+  # in __init__()
+  conds = None
+  # When looking for every difference, whether to stop at the first failed
+  # condition because the later ones depend on it.
+  stop_early = True
+
+  def descents(self, item):
+    conds = self.conds
+    if conds is None:
+      conds = self.conditions()
+
+    for c in conds:
+      if (yield (item, c)) is False and self.stop_early:
+        return
+
+  def conditions(self):
+    """Override this method to generate the comparators to check."""
+    return ()
+
+  def compile(self, compiler):
+    self.conds = tuple(map(compiler.compile, self.conditions()))
+
 class Equal(ValueComparator):
   """Compares using python's == ."""
+  __slots__ = ()
+
   def equals(self, item, comp):
     return self.value == item
 
+  def mismatches(self, items):
+    return mismatches(items, self.value, False,
+                      lambda a, v: a != v,
+                      lambda i, v: not v == i)
+
 class Is(ValueComparator):
   """Compares using python's is."""
+  __slots__ = ()
+
   def equals(self, item, comp):
     return self.value is item
 
   def render_value(self, value):
     return "%s (id = %i)" % (super(Is, self).render_value(value), id(value))
 
+  def arguments(self):
+    # these are the same object when loaded
+    if not (self.value is None or isinstance(self.value, (bool, type))):
+      raise TypeError("Is(%s) can't be dumped" % REPR.repr(self.value))
+    return (self.value,)
+
 class Type(TransformComparator):
   """Takes type(item) and then compares."""
+  __slots__ = ()
+
   def transform(self, item):
     return type(item)
 
@@ -386,20 +1654,62 @@ class Type(TransformComparator):
   
 class InstanceOf(ValueComparator):
   """Compares using python's isinstance()."""
+  __slots__ = ()
+
   def equals(self, item, comp):
     return isinstance(item, self.value)
 
   def render(self):
-    return "instance of %s" % self.value
+    return "instance of %s" % (self.value,)
 
   def render_value(self, value):
     return "instance of %s" % type(value)
 
+# type: the InstanceOf comparator shared by all the comparators that need it
+INSTANCE_OF = {}
+
+def instance_of(cls):
+  """
+  Returns: InstanceOf(cls), the same one each time, so that comparing a
+    container doesn't need a new one.
+  """
+  comparator = INSTANCE_OF.get(cls)
+  if comparator is None:
+    comparator = INSTANCE_OF[cls] = InstanceOf(cls)
+  return comparator
+
 class DoesNotExist(object):
   pass
 
+class Raised(Comparator):
+  """Takes the place of a comparator that raised an exception, so that
+  the exception is reported as a difference, see Comparison."""
+  __slots__ = ("comparator", "error")
+
+  def __init__(self, comparator, error):
+    self.comparator = comparator
+    self.error = error
+
+  def equals(self, item, comp):
+    return False
+
+  def expr(self, expr):
+    return self.comparator.expr(expr)
+
+  def render(self):
+    return "no exception from %s" % REPR.repr(self.comparator)
+
+  def render_value(self, value):
+    return "%s: %s, from %s" % (type(self.error).__name__, self.error,
+                                REPR.repr(value))
+
+  def __repr__(self):
+    return "Raised(%r, %r)" % (self.comparator, self.error)
+
 class IndexedElem(TransformComparator):
   """Compares against item[some index]."""
+  __slots__ = ("index",)
+
   def __init__(self, index, value):
     self.index = index
     self.value = value
@@ -413,91 +1723,484 @@ class IndexedElem(TransformComparator):
   def trans_args(self):
     return "%s" % repr(self.index)
 
+  def arguments(self):
+    return (self.index, self.value)
+
 class Len(TransformComparator):
   """Compares against len(item)."""
+  __slots__ = ()
+
   def transform(self, item):
     return len(item)
 
   def expr(self, expr):
     return "len(%s)" % expr
 
-class Listish(ValueComparator):
+class Listish(ValueComparator, Conjunction):
   """Base class for comparing against specific collections."""
-  def equals(self, item, comp):
+  __slots__ = ("conds",)
+
+  def __init__(self, value):
+    ValueComparator.__init__(self, value)
+    self.conds = None
+
+  def descents(self, item):
+    conds = self.conds
+    if conds is None:
+      v = self.value
+      guards = (instance_of(self.mytype), Len(len(v)))
+      elems = (IndexedElem(i, v[i]) for i in range(0, len(v)))
+    else:
+      guards = conds[:2]
+      elems = conds[2:]
+
+    for c in guards:
+      if (yield (item, c)) is False:
+        return
+
+    # elements are independent, carry on past a difference
+    for c in elems:
+      yield (item, c)
+
+  def conditions(self):
     v = self.value
 
-    for c in (InstanceOf(self.mytype), Len(len(v))):
-      if not comp.descend(item, c):
-        return False
+    yield instance_of(self.mytype)
+    yield Len(len(v))
 
     for i in range(0, len(v)):
-      if not comp.descend(item, IndexedElem(i, v[i])):
-        return False
-
-    return True
+      yield IndexedElem(i, v[i])
 
 class List(Listish):
   """Compare as a list, element by element."""
+  __slots__ = ()
+
   mytype = list
 
 class Tuple(Listish):
   """Compare as a tuple, element by element."""
-  mytype = tuple
+  __slots__ = ()
 
-class EqSet(ValueComparator):
-  """Compare as a set (not as a bag!)."""
-  def equals(self, item, comp):
-    matched = []
-    missing = []
-    extra = {}
+  mytype = tuple
 
+def freeze(item, tolerant=False):
+  """
+  Returns: (key, plain) where key is a hashable stand-in for item, so that
+    items with equal keys are equal, or DoesNotExist if there isn't one.
+    plain is true if item is made only of builtin scalars and containers,
+    in which case items with unequal keys are also unequal. Comparators
+    are frozen by identity. If tolerant is true, floats aren't plain, as
+    they are compared with a tolerance, see diff().
+  """
+  t = type(item)
+  if t in EQUAL_TYPES or item is None:
+    return (item, not (tolerant and t is float))
+  elif isinstance(item, Comparator):
+    return (("comparator", id(item)), False)
+  elif t in (list, tuple, set, frozenset, dict):
+    plain = True
+    keys = []
+    if t is dict:
+      item = item.items()
     for i in item:
-      extra[i] = None
+      (key, p) = freeze(i, tolerant)
+      if key is DoesNotExist:
+        return (DoesNotExist, False)
+      keys.append(key)
+      plain = plain and p
+    if t in (list, tuple):
+      keys = tuple(keys)
+    else:
+      keys = frozenset(keys)
+    return ((t.__name__, keys), plain)
+
+  try:
+    hash(item)
+  except TypeError:
+    return (DoesNotExist, False)
+
+  return (item, False)
+
+def candidates(template, groups, extra, indexes, tolerant):
+  """Used by EqSet to avoid comparing every pending element of its value
+  with every extra item. A dict can only match dicts with the same keys
+  and, for each of its values that is plain (see freeze()), an equal value,
+  so those are looked up in an index of the items.
+
+  Arguments:
+    groups: lists of the positions in extra of equal items.
+    indexes: the indexes made so far, see index_groups().
+    tolerant: see freeze().
+  Returns: the positions in groups of the groups that might match template.
+  """
+  if type(template) is not dict or find_wrapper(dict) is not Dict:
+    return range(len(groups))
+
+  keys = []
+  frozen = []
+  for (k, v) in template.items():
+    (key, plain) = freeze(v, tolerant)
+    if plain:
+      keys.append(k)
+      frozen.append(key)
+  if not keys:
+    return range(len(groups))
+
+  keys = tuple(keys)
+  index = indexes.get(keys)
+  if index is None:
+    index = indexes[keys] = index_groups(keys, groups, extra, tolerant)
+  (buckets, loose) = index
+
+  found = buckets.get(tuple(frozen), [])
+  if loose:
+    found = sorted(found + loose)
+  return found
+
+def index_groups(keys, groups, extra, tolerant):
+  """Used by candidates().
+
+  Returns: (buckets, loose), buckets is a dict of the positions in groups of
+    the dicts that have all of keys, by the frozen values at those keys.
+    loose is a list of the positions of the rest of the items that might
+    match a dict, e.g. dicts with values that aren't plain.
+  """
+  buckets = {}
+  loose = []
+  for (n, ns) in enumerate(groups):
+    item = extra[ns[0]][1]
+    if type(item) is not dict:
+      if isinstance(item, dict):
+        loose.append(n)
+      continue
+
+    frozen = []
+    for k in keys:
+      if k not in item:
+        break
+      (key, plain) = freeze(item[k], tolerant)
+      if not plain:
+        loose.append(n)
+        break
+      frozen.append(key)
+    else:
+      buckets.setdefault(tuple(frozen), []).append(n)
 
-    for c in self.value:
-      found = False
-      for i in extra:
-        if c == i:
+  return (buckets, loose)
+
+def copy_plain(item, memo):
+  """
+  Returns: a copy of item, copying the builtin containers inside it but
+    nothing else, e.g. not the comparators.
+
+  Arguments:
+    memo: id(container): its copy, for the containers copied so far.
+  """
+  t = type(item)
+  if t not in (list, tuple, set, frozenset, dict):
+    return item
+
+  key = id(item)
+  copied = memo.get(key)
+  if copied is not None:
+    return copied
+
+  if t is list:
+    copied = memo[key] = []
+    copied.extend(copy_plain(i, memo) for i in item)
+  elif t is dict:
+    copied = memo[key] = {}
+    for (k, v) in item.items():
+      copied[k] = copy_plain(v, memo)
+  else:
+    copied = memo[key] = t(copy_plain(i, memo) for i in item)
+
+  return copied
+
+def max_matching(adj, right):
+  """Find a maximum matching in a bipartite graph using Hopcroft-Karp.
+
+  Arguments:
+    adj: a list with an entry for each left vertex, the list of the right
+      vertices (numbered from 0) it is connected to.
+    right: the number of right vertices.
+  Returns: a list with an entry for each left vertex, the right vertex it is
+    matched to or -1.
+  """
+  left = len(adj)
+  match_l = [-1] * left
+  match_r = [-1] * right
+
+  # A greedy start leaves much less for the main loop to do. Left vertices
+  # often share their list of edges, so carry on from where the last one
+  # stopped.
+  start = {}
+  for u in range(left):
+    edges = adj[u]
+    n = start.get(id(edges), 0)
+    while n < len(edges):
+      v = edges[n]
+      n += 1
+      if match_r[v] == -1:
+        match_l[u] = v
+        match_r[v] = u
+        break
+    start[id(edges)] = n
+
+  while True:
+    # find the shortest augmenting paths, layering the left vertices
+    free = [u for u in range(left) if match_l[u] == -1]
+    dist = [-1] * left
+    for u in free:
+      dist[u] = 0
+    found = False
+    queue = free[:]
+    for u in queue:
+      for v in adj[u]:
+        w = match_r[v]
+        if w == -1:
           found = True
-          matched.append(i)
-          del(extra[i])
-          break
+        elif dist[w] == -1:
+          dist[w] = dist[u] + 1
+          queue.append(w)
+
+    if not found:
+      return match_l
+
+    # augment along vertex-disjoint shortest paths, the stack is explicit
+    # as paths can be very long
+    pos = [0] * left
+    for root in free:
+      stack = [root]
+      path = []
+      while stack:
+        u = stack[-1]
+        edges = adj[u]
+        while pos[u] < len(edges):
+          v = edges[pos[u]]
+          pos[u] += 1
+          w = match_r[v]
+          if w == -1:
+            path.append(v)
+            for (u2, v2) in zip(stack, path):
+              match_l[u2] = v2
+              match_r[v2] = u2
+            stack = []
+            break
+          elif dist[w] == dist[u] + 1:
+            path.append(v)
+            stack.append(w)
+            break
+        else:
+          # a dead end, don't come back here
+          dist[u] = -1
+          stack.pop()
+          if path:
+            path.pop()
 
-      if not found:
-        missing.append(c)
+class EqSet(ValueComparator):
+  """Compare as a set (not as a bag!). Elements of the value can be
+  comparators or contain comparators, each is matched to a different
+  element of item."""
+  __slots__ = ()
+
+  bag = False
+
+  def equals(self, item, comp):
+    (matched, missing, extra) = self.match(item, comp)
 
     if len(missing) or len(extra):
-      self.matched = matched
-      self.missing = missing
-      self.extra = list(extra.keys())
+      comp.explain(item, Unmatched(self, matched, missing, extra))
       return False
     else:
       return True
 
+  def match(self, item, comp):
+    """
+    Returns: (matched, missing, extra), lists of the elements of item that
+      matched, the elements of the value that didn't and the elements of item
+      that didn't.
+    """
+    # Items that can be frozen are grouped by key, the rest are alone. Each
+    # entry is a list of (position, item, plain) so that extras can be
+    # reported in order.
+    tolerant = comp.tolerance is not None
+    groups = {}
+    loose = []
+    for (pos, i) in enumerate(item):
+      (key, plain) = freeze(i, tolerant)
+      if key is DoesNotExist:
+        loose.append([(pos, i, plain)])
+      else:
+        group = groups.get(key)
+        if group is None:
+          groups[key] = [(pos, i, plain)]
+        elif self.bag:
+          group.append((pos, i, plain))
+
+    # Plain elements are found by key. Everything else needs to be compared
+    # one by one and matched up.
+    matched = []
+    pending = {}
+    for c in self.value:
+      (key, plain) = freeze(c, tolerant)
+      if plain:
+        group = groups.get(key)
+        if group:
+          matched.append(group.pop()[1])
+          continue
+      else:
+        if key is DoesNotExist:
+          key = ("template", id(c))
+      if key in pending:
+        pending[key][1].append(c)
+      else:
+        pending[key] = (plain, [c])
+
+    extra = [i for group in list(groups.values()) + loose for i in group]
+    missing = []
+    if pending and extra:
+      missing = self.match_pending(list(pending.values()), extra, matched,
+                                   comp)
+    else:
+      for (plain, cs) in pending.values():
+        missing.extend(cs)
+
+    extra.sort(key=lambda e: e[0])
+    return (matched, missing, [e[1] for e in extra])
+
+  def match_pending(self, pending, extra, matched, comp):
+    """Find the largest matching between the pending elements of the value
+    and the extra items, moving matched items from extra into matched.
+
+    Arguments:
+      pending: a list of (plain, [c...]) for each group of equal elements
+        of the value
+      extra: a list of (position, item, plain)
+    Returns: the pending elements that couldn't be matched.
+    """
+    # group equal items so each group only needs to be compared once
+    item_groups = {}
+    for (n, e) in enumerate(extra):
+      (key, plain) = freeze(e[1])
+      if key is DoesNotExist:
+        key = ("item", n)
+      item_groups.setdefault(key, []).append(n)
+
+    groups = list(item_groups.values())
+    # (keys): the index of groups made by index_groups() for those keys
+    indexes = {}
+
+    adj = []
+    left = []
+    for (plain, cs) in pending:
+      edges = []
+      for n in candidates(cs[0], groups, extra, indexes,
+                          comp.tolerance is not None):
+        ns = groups[n]
+        e = extra[ns[0]]
+        # plain against plain was already settled by key
+        if not (plain and e[2]) and comp.probe(e[1], cs[0]):
+          edges.extend(ns)
+      for c in cs:
+        adj.append(edges)
+        left.append(c)
+
+    match = max_matching(adj, len(extra))
+
+    missing = []
+    for (c, v) in zip(left, match):
+      if v == -1:
+        missing.append(c)
+      else:
+        matched.append(extra[v][1])
+
+    used = set(match)
+    extra[:] = [e for (n, e) in enumerate(extra) if n not in used]
+
+    return missing
+
+  def compile(self, compiler):
+    # the elements are frozen rather than wrapped, so they stay as they are,
+    # except those that must be compared with the tolerance
+    value = copy_plain(self.value, {})
+    if compiler.comparison.tolerance is not None:
+      elems = [c if freeze(c, True)[1] else compiler.compile(c)
+               for c in value]
+      if type(value) in (list, tuple, set, frozenset):
+        value = type(value)(elems)
+      else:
+        value = elems
+    self.value = value
+
   def render(self):
     return "%i matching element(s)" % len(self.value)
 
   def render_value(self, value):
-    return "%i matching element(s), extra: %s, missing: %s" % \
-           (len(self.matched), self.extra, self.missing)
+    # e.g. a result from the cache, the comparison didn't explain it
+    (matched, missing, extra) = self.match(value, Comparison())
+    return Unmatched(self, matched, missing, extra).render_value(value)
 
   def expr(self, expr):
     return "%s as a set (==)" % expr
 
+class Unmatched(Comparator):
+  """Takes the place of an EqSet that found a difference, to say which
+  elements didn't match."""
+  __slots__ = ("comparator", "matched", "missing", "extra")
+
+  def __init__(self, comparator, matched, missing, extra):
+    self.comparator = comparator
+    self.matched = matched
+    self.missing = missing
+    self.extra = extra
+
+  def equals(self, item, comp):
+    return False
+
+  def expr(self, expr):
+    return self.comparator.expr(expr)
+
+  def render(self):
+    return self.comparator.render()
+
+  def render_value(self, value):
+    return "%i matching element(s), extra: %s, missing: %s" % \
+           (len(self.matched), REPR.repr(self.extra), REPR.repr(self.missing))
+
+  def __repr__(self):
+    return "Unmatched(%r)" % (self.comparator,)
+
 class Set(EqSet):
   """Compare to builtin set item."""
+  __slots__ = ()
+
   def equals(self, item, comp):
-    return (comp.descend(item, InstanceOf(set)) and
+    return (comp.descend(item, instance_of(set)) and
             EqSet.equals(self, item, comp))
 
 class Frozenset(EqSet):
   """Compare to builtin frozenset item."""
+  __slots__ = ()
+
   def equals(self, item, comp):
-    return (comp.descend(item, InstanceOf(frozenset)) and
+    return (comp.descend(item, instance_of(frozenset)) and
             EqSet.equals(self, item, comp))
 
+class Bag(EqSet):
+  """Compare as a bag, each element of the value must match a different
+  element of item and vice versa."""
+  __slots__ = ()
+
+  bag = True
+
+  def expr(self, expr):
+    return "%s as a bag" % expr
+
 class HasKeys(TransformComparator):
   """Compare item.keys()."""
+  __slots__ = ()
+
   def __init__(self, value):
     self.value = EqSet(value)
 
@@ -506,33 +2209,148 @@ class HasKeys(TransformComparator):
 
   def expr(self, expr):
     return "%s.keys()" % expr
+
+  def arguments(self):
+    return (self.value.value,)
       
-class Dict(ValueComparator):
+class Dict(ValueComparator, Composite):
   """Check that item is a dict and compare it element by element."""
-  def equals(self, item, comp):
+  __slots__ = ("elems", "conds")
+
+  def __init__(self, value):
+    ValueComparator.__init__(self, value)
+    self.elems = {}
+    self.conds = None
+
+  def descents(self, item):
     v = self.value
 
-    for c in (InstanceOf(dict), HasKeys(list(v.keys()))):
-      if not comp.descend(item, c):
-        return False
+    if (yield (item, instance_of(dict))) is False:
+      return
 
-    for i in item:
-      if not comp.descend(item, IndexedElem(i, v[i])):
-        return False
+    # comparing the key views is cheap, HasKeys is only needed to explain
+    # a difference or when there are Optional values
+    same_keys = item.keys() == v.keys()
+    if not same_keys:
+      yield (item, HasKeys([k for k in v
+                            if k in item or not isinstance(v[k], Optional)]))
 
-    return True
+    elems = self.conds
+    if elems is None:
+      elems = self.elements()
+
+    # elements are independent, carry on past a difference
+    for elem in elems:
+      if same_keys or elem.index in item:
+        yield (item, elem)
+
+  def elements(self):
+    """Generates an IndexedElem for each key, reusing those from earlier
+    comparisons unless the value has been replaced since."""
+    v = self.value
+    elems = self.elems
+
+    for i in v:
+      value = v[i]
+      elem = elems.get(i)
+      if elem is None or elem.value is not value:
+        elem = elems[i] = IndexedElem(i, value)
+      yield elem
+
+  def compile(self, compiler):
+    # the keys are still compared with the value's
+    self.value = copy.copy(self.value)
+    self.elems = {}
+    self.conds = tuple(map(compiler.compile, self.elements()))
+
+class Optional(TransformComparator):
+  """A value in a Dict whose key may be missing from the item. If it's
+  there, or anywhere else, item is compared with the value."""
+  __slots__ = ()
+
+  def transform(self, item):
+    return item
 
-class Object(ValueComparator):
+class Object(ValueComparator, Conjunction):
   """Compare to another object. Check that the types match and that the
   attribute dictionaries match."""
-  def equals(self, item, comp):
+  __slots__ = ("conds",)
+
+  def __init__(self, value):
+    ValueComparator.__init__(self, value)
+    self.conds = None
+
+  def descents(self, item):
+    # normally caught by descend() but not once the object is compiled
+    if item is self.value:
+      return
+
+    conds = self.conds
+    if conds is None:
+      conds = self.conditions()
+
+    for c in conds:
+      if (yield (item, c)) is False:
+        return
+
+  def conditions(self):
+    v = self.value
+
+    yield instance_of(v.__class__)
+    # objects without a __dict__ (e.g. None) can't be compiled otherwise
+    yield Attr("__dict__", getattr(v, "__dict__", DoesNotExist))
+
+class Fields(ValueComparator, Conjunction):
+  """Compare to another object. Check that the types match and compare
+  the objects' fields one by one, see fields_of(). This works for objects
+  without a __dict__ and doesn't need to build one for those that do."""
+  __slots__ = ("fields", "conds")
+
+  def __init__(self, value, fields=None):
+    """
+    Arguments:
+      fields: the names of the attributes to compare, by default the
+        fields of the value's class, see fields_of().
+    """
+    ValueComparator.__init__(self, value)
+    if fields is None:
+      fields = fields_of(type(value))
+      if fields is None:
+        raise TypeError("%s has no fields, name the ones to compare" %
+                        type_name(type(value)))
+    self.fields = fields
+    self.conds = None
+
+  def descents(self, item):
+    if item is self.value:
+      return
+
+    conds = self.conds
+    if conds is None:
+      conds = self.conditions()
+
+    guard = True
+    for c in conds:
+      # the fields are independent, carry on past a difference
+      if (yield (item, c)) is False and guard:
+        return
+      guard = False
+
+  def conditions(self):
     v = self.value
 
-    return comp.descend(item, InstanceOf(v.__class__)) and \
-           comp.descend(item, Attr("__dict__", v.__dict__))
+    yield instance_of(v.__class__)
+    for name in self.fields:
+      yield Field(name, getattr(v, name, DoesNotExist))
+
+  def arguments(self):
+    fields = self.fields
+    return (self.value, None if fields is None else list(fields))
 
 class HasAttr(TransformComparator):
   """Check that item has a given attribute."""
+  __slots__ = ("attr",)
+
   def __init__(self, attr, value=True):
     self.attr = attr
     self.value = value
@@ -546,8 +2364,13 @@ class HasAttr(TransformComparator):
   def trans_args(self):
     return repr(self.attr)
 
+  def arguments(self):
+    return (self.attr, self.value)
+
 class CmpAttr(TransformComparator):
   """Compare item.some_attribute."""
+  __slots__ = ("attr",)
+
   def __init__(self, attr, value):
     self.attr = attr
     self.value = value
@@ -561,23 +2384,43 @@ class CmpAttr(TransformComparator):
   def trans_args(self):
     return repr(self.attr)
 
-class Attr(Comparator):
+  def arguments(self):
+    return (self.attr, self.value)
+
+class Field(CmpAttr):
+  """Like CmpAttr but a missing attribute is DoesNotExist, e.g. an empty
+  slot."""
+  __slots__ = ()
+
+  def transform(self, item):
+    return getattr(item, self.attr, DoesNotExist)
+
+class Attr(Conjunction):
   """Check that item.some_attr exists and compare it to some value."""
+  __slots__ = ("hasattr", "cmpattr", "conds")
+
   def __init__(self, attr, value):
     self.hasattr = HasAttr(attr)
     self.cmpattr = CmpAttr(attr, value)
+    self.conds = None
 
-  def equals(self, item, comp):
-    return comp.descend(item, self.hasattr) and \
-           comp.descend(item, self.cmpattr)
+  def conditions(self):
+    return (self.hasattr, self.cmpattr)
+
+  def arguments(self):
+    return (self.cmpattr.attr, self.cmpattr.value)
 
-class Attrs(ValueComparator):
+class Attrs(ValueComparator, Conjunction):
   """Check that item has certain attributes and compare them to some
   values. This can be created in several ways:
   Attrs(attr1=value1, attr2=value)
   Attrs([(attr1, value1), (attr2, value2)])
   Attrs({attr1 : value1, attr2 : value2 })
   """
+  __slots__ = ("elems", "conds")
+
+  stop_early = False
+
   def __init__(self, *args, **qargs):
     if args:
       if qargs:
@@ -588,21 +2431,28 @@ class Attrs(ValueComparator):
     else:
       value = qargs
     ValueComparator.__init__(self, value)
+    self.elems = {}
+    self.conds = None
 
-  def equals(self, item, comp):
+  def conditions(self):
+    """Generates an Attr for each attribute, reusing those from earlier
+    comparisons unless the value has been replaced since, as Dict does."""
     v = self.value
     if isinstance(v, dict):
       items = list(v.items())
     else:
       items = v
+    elems = self.elems
     for (attr, c) in items:
-      if not comp.descend(item, Attr(attr, c)):
-        return False
-
-    return True
+      elem = elems.get(attr)
+      if elem is None or elem.cmpattr.value is not c:
+        elem = elems[attr] = Attr(attr, c)
+      yield elem
 
 class Call(TransformComparator):
   """Calls item(some, args) and compares the result to some value."""
+  __slots__ = ("args", "kwargs")
+
   def __init__(self, value, args=[], kwargs={}):
     self.value = value
     self.args = args
@@ -623,19 +2473,28 @@ class Call(TransformComparator):
 
     return "%s(%s)" % (expr, ", ".join(args))
 
-class AndA(Comparator):
+  def compile(self, compiler):
+    TransformComparator.compile(self, compiler)
+    self.args = list(self.args)
+    self.kwargs = dict(self.kwargs)
+
+  def arguments(self):
+    return (self.value, self.args, self.kwargs)
+
+class AndA(Conjunction):
   """Checks that each of an array of comparators successfully compare against
   item."""
+  __slots__ = ("conds",)
+
   def __init__(self, conds):
     self.conds = conds
 
-  def equals(self, item, comp):
-    for cond in self.conds:
-      if not comp.descend(item, cond):
-        return False
+  def conditions(self):
+    return self.conds
+
+  def arguments(self):
+    return (self.conds,)
 
-    return True
-    
   def render(self):
     return self.render_value(self.value)
 
@@ -645,43 +2504,100 @@ class AndA(Comparator):
 class And(AndA):
   """As AndA but instead of passing in an array object, the argument list
   to the constructor is turned into an array object."""
+  __slots__ = ()
+
   def __init__(self, *conds):
     AndA.__init__(self, conds)
 
+  def arguments(self):
+    return tuple(self.conds)
+
 class Ignore(Comparator):
   """This comparator always succeeds."""
+  __slots__ = ()
+  # it has no state so there's only one of each class
+  instance = None
+
+  def __new__(cls):
+    if cls.__dict__.get("instance") is None:
+      cls.instance = Comparator.__new__(cls)
+    return cls.instance
+
   def equals(self, item, comp):
     return True
-    
+
+  def arguments(self):
+    return ()
+
   def __repr__(self):
     return "Ignore"
 
+# (type, regex, flags): the compiled pattern, shared by all Re comparators
+PATTERNS = collections.OrderedDict()
+# the most patterns kept in PATTERNS
+MAX_PATTERNS = 1000
+
+def compile_pattern(regex, flags=0):
+  """
+  Returns: re.compile(regex, flags), reusing the compiled pattern from an
+    earlier call if it's still in PATTERNS.
+  """
+  key = (type(regex), regex, flags)
+  pattern = PATTERNS.get(key)
+  if pattern is None:
+    pattern = PATTERNS[key] = re.compile(regex, flags)
+    if len(PATTERNS) > MAX_PATTERNS:
+      PATTERNS.popitem(last=False)
+
+  return pattern
+
 class Re(Comparator):
-  """Check that item matches a regular expression (using re.search)."""
-  def __init__(self, regex, flags=0):
-    if type(regex) is str:
+  """Check that item is a string that matches a regular expression. mode
+  is the method of the pattern to use, "search" (the default), "match" or
+  "fullmatch". Anything that isn't the same type of string as the regular
+  expression doesn't match."""
+  __slots__ = ("orig", "regex", "flags", "mode", "test", "kind")
+
+  def __init__(self, regex, flags=0, mode="search"):
+    self.flags = flags
+    if isinstance(regex, (str, bytes)):
       self.orig = "%s" % repr(regex)
       if flags:
         self.orig += " (flags=%d)" % flags
-      regex = re.compile(regex, flags)
+      regex = compile_pattern(regex, flags)
     else:
       self.orig = repr(regex)
+    if mode != "search":
+      self.orig += " (%s)" % mode
     self.regex = regex
+    self.mode = mode
+    self.test = getattr(regex, mode)
+    self.kind = type(regex.pattern)
 
   def equals(self, item, comp):
-    if self.regex.search(item):
-      return True
-    else:
-      return False
+    return isinstance(item, self.kind) and self.test(item) is not None
+
+  def mismatches(self, items):
+    # one loop rather than a comparison for each element
+    (test, kind) = (self.test, self.kind)
+    for (i, item) in enumerate(items):
+      if not isinstance(item, kind) or test(item) is None:
+        yield i
 
   def render(self):
     return "something matching %s" % self.orig
 
+  def arguments(self):
+    flags = self.flags or self.regex.flags & ~re.UNICODE
+    return (self.regex.pattern, int(flags), self.mode)
+
   def __repr__(self):
     return "%s(%s)" % (self.__class__.__name__, self.orig)
 
-class Slice(Comparator):
+class Slice(Composite):
   """Compare certain indexed elements of item against the value."""
+  __slots__ = ("value", "indices")
+
   def __init__(self, value, indices):
     """
     Arguments:
@@ -691,29 +2607,732 @@ class Slice(Comparator):
     self.value = value
     self.indices = indices
 
-  def equals(self, item, comp):
+  def descents(self, item):
     value = self.value
     indices = self.indices
 
     for i in indices:
-      if not comp.descend(item, IndexedElem(i, value)):
-        return False
+      yield (item, IndexedElem(i, value))
 
-    return True
+  def compile(self, compiler):
+    self.value = compiler.compile(self.value)
 
   def render(self):
     return self.render_value(self.value)
 
+  def arguments(self):
+    return (self.value, self.indices)
+
   def __repr__(self):
     return "%s(%s)" % (self.__class__.__name__, repr(self.value))
 
-class ArrayValues(ValueComparator):
+class ArrayValues(ValueComparator, Composite):
   """ Compare each element of an array to the value """
-  def equals(self, item, comp):
-    return comp.descend(item, Slice(self.value, range(0, len(item))))
-                        
-class DictValues(ValueComparator):
+  __slots__ = ()
+
+  def descents(self, item):
+    value = self.value
+    if isinstance(value, Comparator) and isinstance(item, ARRAY_TYPES) and \
+       batches(type(value)):
+      # the comparator can find the elements that don't match in one pass
+      for i in value.mismatches(item):
+        yield (item, IndexedElem(i, value))
+    else:
+      yield (item, Slice(value, range(0, len(item))))
+
+  def compile(self, compiler):
+    self.value = compiler.compile(self.value)
+
+# class: whether ArrayValues can use its mismatches(), see batches()
+BATCHES = {}
+
+def batches(cls):
+  """
+  Returns: true if ArrayValues can use the mismatches() method of comparators
+    of class cls. It must come from the same class as equals(), so that a
+    subclass that only overrides equals() is still used.
+  """
+  found = BATCHES.get(cls)
+  if found is None:
+    found = False
+    for c in cls.__mro__:
+      if "equals" in c.__dict__ or "mismatches" in c.__dict__:
+        found = "equals" in c.__dict__ and \
+          c.__dict__.get("mismatches") is not None
+        break
+    BATCHES[cls] = found
+
+  return found
+
+class DictValues(ValueComparator, Composite):
   """ Compare each value in a dictionary to the value """
-  def equals(self, item, comp):
-    return comp.descend(item, Slice(self.value, list(item.keys())))
+  __slots__ = ()
+
+  def descents(self, item):
+    yield (item, Slice(self.value, list(item.keys())))
+
+  def compile(self, compiler):
+    self.value = compiler.compile(self.value)
                         
+
+# The sequences that array comparators and ArrayValues can compare in one
+# pass.
+ARRAY_TYPES = (list, tuple, array.array) + (
+  () if numpy is None else (numpy.ndarray,))
+
+NUMBER_TYPES = (int, float, bool)
+
+# numpy compares ints with floats by converting the ints to floats, which
+# is only exact for ints up to this size
+EXACT = 2 ** 53
+
+def numeric_array(items):
+  """
+  Returns: items as a 1 dimensional numpy array of numbers, or None if numpy
+    is missing, items is anything else or making the array would change some
+    of the numbers, e.g. a large int in a list with floats.
+  """
+  if numpy is None:
+    return None
+  try:
+    a = numpy.asarray(items)
+  except Exception:
+    return None
+  if a.ndim != 1 or a.dtype.kind not in "biuf":
+    return None
+
+  if a.dtype.kind == "f" and not isinstance(items, (numpy.ndarray,
+                                                    array.array)) and \
+     not (abs(a) < EXACT).all():
+    # only look for the ints that were rounded if there might be some
+    for item in items:
+      if isinstance(item, int) and not -EXACT <= item <= EXACT:
+        return None
+
+  return a
+
+def exact(a):
+  """
+  Returns: true if every number in the numpy array a converts to a float
+    exactly.
+  """
+  if a.dtype.kind == "f":
+    return True
+  try:
+    return bool(((a >= -EXACT) & (a <= EXACT)).all())
+  except TypeError:
+    return False
+
+def comparable(a, v):
+  """
+  Returns: true if numpy compares the numbers in the array a with v, a
+    number or an array, as python would.
+  """
+  v = numpy.asarray(v)
+  return a.dtype.kind == v.dtype.kind or (exact(a) and exact(v))
+
+def mismatches(items, value, pairwise, vector, scalar):
+  """Generates the index of each element of items that fails a test.
+
+  Arguments:
+    value: a number to test every element against or, if pairwise is true,
+      a sequence with a number to test each element against.
+    vector: vector(a, v) tests a numpy array in one go, returning an array
+      that is true for the failures.
+    scalar: scalar(item, v) is true if item fails, used when numpy is missing
+      or can't handle the items.
+  """
+  a = numeric_array(items)
+  if a is not None:
+    if pairwise:
+      v = numeric_array(value)
+    elif type(value) in NUMBER_TYPES:
+      v = value
+    else:
+      v = None
+
+    if v is not None and comparable(a, v):
+      try:
+        failed = vector(a, v)
+      except (TypeError, ValueError, OverflowError):
+        failed = None
+      if failed is not None:
+        for i in numpy.flatnonzero(failed):
+          yield int(i)
+        return
+
+  if numpy is not None:
+    # numpy's numbers compare like numpy's arrays, python's are exact
+    if isinstance(items, numpy.ndarray):
+      items = items.tolist()
+    if pairwise and isinstance(value, numpy.ndarray):
+      value = value.tolist()
+
+  if pairwise:
+    pairs = zip(items, value)
+  else:
+    pairs = ((item, value) for item in items)
+  for (i, (item, v)) in enumerate(pairs):
+    if scalar(item, v):
+      yield i
+
+def element(items, i):
+  """
+  Returns: items[i], as a plain python number if it's a numpy one.
+  """
+  item = items[i]
+  if numpy is not None and isinstance(item, numpy.generic):
+    item = item.item()
+
+  return item
+
+def ulps_apart(a, b):
+  """
+  Returns: the number of steps between the floats a and b, counting each
+    representable float as a step.
+  """
+  if a != a or b != b:
+    # NaN
+    return float("inf")
+
+  (ia, ib) = struct.unpack("<2q", struct.pack("<2d", a, b))
+  # make the integers increase with the floats, -0.0 and 0.0 are both 0
+  if ia < 0:
+    ia = -(1 << 63) - ia
+  if ib < 0:
+    ib = -(1 << 63) - ib
+
+  return abs(ia - ib)
+
+INF = float("inf")
+
+def far(item, value, rtol, atol, ulps=None):
+  """True if item is not within atol + rtol * abs(value) of value and, if
+  ulps is given, is more than ulps floats away from value."""
+  try:
+    # like numpy.isclose(), infinities are only near themselves
+    if item == value or \
+       abs(value) != INF and abs(item - value) <= atol + rtol * abs(value):
+      return False
+    return ulps is None or ulps_apart(float(item), float(value)) > ulps
+  except (TypeError, OverflowError):
+    return True
+
+def vector_far(rtol, atol, ulps):
+  """
+  Returns: a function to pass to mismatches() that does the same as far().
+  """
+  if ulps is not None:
+    # leave it to far()
+    return lambda a, v: None
+
+  def vector(a, v):
+    with numpy.errstate(invalid="ignore"):
+      return ~((a == v) |
+               (numpy.isfinite(v) & (abs(a - v) <= atol + rtol * abs(v))))
+  return vector
+
+class Near(ValueComparator):
+  """Check that item is a number within atol + rtol * abs(value) of value,
+  like numpy.isclose(), or if ulps is given, at most ulps floats away from
+  value. Set rtol and atol to 0 to only use ulps."""
+  __slots__ = ("rtol", "atol", "ulps")
+
+  def __init__(self, value, rtol=1e-05, atol=1e-08, ulps=None):
+    self.value = value
+    self.rtol = rtol
+    self.atol = atol
+    self.ulps = ulps
+
+  def equals(self, item, comp):
+    return not far(item, self.value, self.rtol, self.atol, self.ulps)
+
+  def mismatches(self, items):
+    (rtol, atol, ulps) = (self.rtol, self.atol, self.ulps)
+    return mismatches(items, self.value, False,
+                      vector_far(rtol, atol, ulps),
+                      lambda i, v: far(i, v, rtol, atol, ulps))
+
+  def arguments(self):
+    return (self.value, self.rtol, self.atol, self.ulps)
+
+  def tolerances(self):
+    tols = "rtol=%r, atol=%r" % (self.rtol, self.atol)
+    if self.ulps is not None:
+      tols += ", ulps=%r" % self.ulps
+    return tols
+
+  def render(self):
+    return "%s (%s)" % (self.render_value(self.value), self.tolerances())
+
+  def __repr__(self):
+    return "%s(%r, %s)" % (self.__class__.__name__, self.value,
+                           self.tolerances())
+
+def out_of_range(item, low, high):
+  """True if item is not between low and high."""
+  try:
+    return (low is not None and not item >= low) or \
+      (high is not None and not item <= high)
+  except TypeError:
+    return True
+
+class InRange(Comparator):
+  """Check that low <= item <= high, either limit can be None."""
+  __slots__ = ("low", "high")
+
+  def __init__(self, low=None, high=None):
+    self.low = low
+    self.high = high
+
+  def equals(self, item, comp):
+    return not out_of_range(item, self.low, self.high)
+
+  def mismatches(self, items):
+    (low, high) = (self.low, self.high)
+
+    def vector(a, v):
+      failed = numpy.zeros(len(a), bool)
+      for (limit, inside) in ((low, a.__ge__), (high, a.__le__)):
+        if limit is not None:
+          if type(limit) not in NUMBER_TYPES or not comparable(a, limit):
+            # leave anything else to python
+            return None
+          failed |= ~inside(limit)
+      return failed
+
+    return mismatches(items, 0, False, vector,
+                      lambda i, v: out_of_range(i, low, high))
+
+  def render(self):
+    if self.high is None:
+      return "something >= %r" % (self.low,)
+    elif self.low is None:
+      return "something <= %r" % (self.high,)
+    else:
+      return "something between %r and %r" % (self.low, self.high)
+
+  def arguments(self):
+    return (self.low, self.high)
+
+  def __repr__(self):
+    return "%s(%r, %r)" % (self.__class__.__name__, self.low, self.high)
+
+class ArrayEqual(ValueComparator, Composite):
+  """Compare a sequence of numbers (a list, tuple, array.array or numpy
+  array) element by element with the numbers in value. This takes one pass
+  over the sequences, which is vectorised if numpy is available, and only
+  descends into the elements that differ."""
+  __slots__ = ()
+
+  def descents(self, item):
+    v = self.value
+
+    if (yield (item, instance_of(ARRAY_TYPES))) is False:
+      return
+    if (yield (item, Len(len(v)))) is False:
+      return
+
+    if numpy is not None and isinstance(v, numpy.ndarray) and v.ndim > 1:
+      # row by row, each row is compared like this
+      for i in range(len(v)):
+        row = copy.copy(self)
+        row.value = v[i]
+        yield (item, IndexedElem(i, row))
+      return
+
+    for i in self.unequal(item):
+      yield (item, IndexedElem(i, self.element(element(v, i))))
+
+  def compile(self, compiler):
+    self.value = copy.copy(self.value)
+
+  def unequal(self, item):
+    """Generates the index of each element of item that doesn't match."""
+    return mismatches(item, self.value, True,
+                      lambda a, v: a != v,
+                      lambda i, v: not v == i)
+
+  def element(self, value):
+    """
+    Returns: the comparator for a single element.
+    """
+    return Equal(value)
+
+def wrap_ndarray(value):
+  """The wrapper for numpy arrays, see register_wrapper()."""
+  if value.ndim == 0:
+    return Equal(value.item())
+  return ArrayEqual(value)
+
+class ArrayNear(ArrayEqual):
+  """Like ArrayEqual but each element only has to be Near its value."""
+  __slots__ = ("rtol", "atol", "ulps")
+
+  def __init__(self, value, rtol=1e-05, atol=1e-08, ulps=None):
+    self.value = value
+    self.rtol = rtol
+    self.atol = atol
+    self.ulps = ulps
+
+  def unequal(self, item):
+    (rtol, atol, ulps) = (self.rtol, self.atol, self.ulps)
+    return mismatches(item, self.value, True,
+                      vector_far(rtol, atol, ulps),
+                      lambda i, v: far(i, v, rtol, atol, ulps))
+
+  def element(self, value):
+    return Near(value, self.rtol, self.atol, self.ulps)
+
+  def arguments(self):
+    return (self.value, self.rtol, self.atol, self.ulps)
+
+def type_name(cls):
+  """
+  Returns: the name dump() uses for cls, short for builtins and deep's
+    comparators.
+  """
+  module = cls.__module__
+  name = getattr(cls, "__qualname__", cls.__name__)
+  if module in ("builtins", "__builtin__") or \
+     module == __name__ and issubclass(cls, Comparator):
+    return name
+  return "%s.%s" % (module, name)
+
+# builtin types that can't be found by name
+NAMED_TYPES = {"NoneType": type(None), "ellipsis": type(Ellipsis)}
+
+def named_type(name):
+  """
+  Returns: the class that type_name() gave name to.
+  """
+  cls = NAMED_TYPES.get(name)
+  if cls is not None:
+    return cls
+
+  if "." in name:
+    (module, name) = name.rsplit(".", 1)
+    # a nested class's module is before the first part that isn't a module
+    parts = [name]
+    while True:
+      try:
+        cls = importlib.import_module(module)
+        break
+      except ImportError:
+        if "." not in module:
+          raise
+        (module, part) = module.rsplit(".", 1)
+        parts.insert(0, part)
+  else:
+    (cls, parts) = (sys.modules[__name__], [name])
+    if not hasattr(cls, name):
+      cls = builtins
+
+  for part in parts:
+    cls = getattr(cls, part)
+  if not isinstance(cls, type):
+    raise TypeError("%s is not a class" % name)
+  return cls
+
+def loadable_name(cls):
+  """
+  Returns: type_name(cls), after checking that named_type() finds cls by
+    it, which it doesn't for e.g. a class defined inside a function.
+  """
+  name = type_name(cls)
+  try:
+    found = named_type(name)
+  except Exception:
+    found = None
+  if found is not cls:
+    raise TypeError("%s can't be dumped, it can't be found by name" % name)
+  return name
+
+# Builtin containers whose subclasses are dumped with their items
+ITEM_TYPES = (dict, list, set, frozenset, tuple)
+
+def encode(value, active):
+  """Used by dump(), turns a template into something json can write.
+  Comparators and anything that isn't a list or a JSON scalar become a
+  dict with a single key, the tag.
+
+  Arguments:
+    active: the ids of the containers being encoded, to catch circular
+      templates.
+  """
+  t = type(value)
+  if value is None or t in (bool, int, float, str):
+    return value
+
+  key = id(value)
+  if key in active:
+    raise ValueError("Circular templates can't be dumped")
+  active.add(key)
+  try:
+    if isinstance(value, Comparator):
+      return {loadable_name(t): [encode(a, active)
+                                 for a in value.arguments()]}
+    elif t is list:
+      return [encode(i, active) for i in value]
+    elif t is dict:
+      if all(type(k) is str for k in value):
+        return {"dict": dict((k, encode(v, active))
+                             for (k, v) in value.items())}
+      return {"dict": [[encode(k, active), encode(v, active)]
+                       for (k, v) in value.items()]}
+    elif t in (tuple, set, frozenset):
+      return {t.__name__: [encode(i, active) for i in value]}
+    elif isinstance(value, type):
+      return {"type": loadable_name(value)}
+    elif t in ENCODERS:
+      return {t.__name__: ENCODERS[t](value)}
+    elif t is array.array:
+      return {"array": [value.typecode, value.tolist()]}
+    elif numpy is not None and t is numpy.ndarray:
+      return {"ndarray": [value.dtype.str, value.tolist()]}
+
+    fields = fields_of(t)
+    for base in ITEM_TYPES:
+      if isinstance(value, base) and (base is not tuple or fields is None):
+        # e.g. an OrderedDict, a tuple subclass that isn't a namedtuple
+        return {"items": [loadable_name(t), encode(base(value), active),
+                          encode(dict(getattr(value, "__dict__", {})),
+                                 active)]}
+
+    if fields is None and not hasattr(value, "__dict__") or callable(value):
+      # a callable's __dict__ isn't enough to rebuild it
+      raise TypeError("%s can't be dumped" % REPR.repr(value))
+    state = {}
+    for name in fields or ("__dict__",):
+      if name == "__dict__":
+        state.update(vars(value))
+      elif hasattr(value, name):
+        state[name] = getattr(value, name)
+    return {"object": [loadable_name(t), encode(state, active)]}
+  finally:
+    active.discard(key)
+
+# type: a function that returns the arguments for DECODERS
+ENCODERS = {
+  bytes: lambda v: base64.b64encode(v).decode("ascii"),
+  complex: lambda v: [v.real, v.imag],
+  decimal.Decimal: str,
+  fractions.Fraction: str,
+  datetime.datetime: lambda v: v.isoformat(),
+  datetime.date: lambda v: v.isoformat(),
+  datetime.time: lambda v: v.isoformat(),
+  datetime.timedelta: lambda v: [v.days, v.seconds, v.microseconds],
+  range: lambda v: [v.start, v.stop, v.step],
+  }
+
+def decode_object(name, state):
+  cls = named_type(name)
+  if issubclass(cls, tuple):
+    # e.g. a namedtuple
+    return tuple.__new__(cls, [state[f] for f in fields_of(cls)])
+  value = cls.__new__(cls)
+  for (attr, v) in state.items():
+    object.__setattr__(value, attr, v)
+  return value
+
+def decode_items(name, items, state):
+  """Rebuilds a subclass of one of ITEM_TYPES, without calling __init__(),
+  as pickle does."""
+  cls = named_type(name)
+  if issubclass(cls, (tuple, frozenset)):
+    value = cls.__new__(cls, items)
+  else:
+    value = cls.__new__(cls)
+    if issubclass(cls, dict):
+      for (k, v) in items.items():
+        value[k] = v
+    elif issubclass(cls, list):
+      value.extend(items)
+    else:
+      value.update(items)
+  for (attr, v) in state.items():
+    object.__setattr__(value, attr, v)
+  return value
+
+def decode_dict(args):
+  if type(args) is dict:
+    return dict((k, decode(v)) for (k, v) in args.items())
+  return dict((decode(k), decode(v)) for (k, v) in args)
+
+# tag: a function that takes the decoded arguments and returns the value,
+# the arguments of the tags in RAW are not decoded
+DECODERS = {
+  "dict": decode_dict,
+  "tuple": tuple,
+  "set": set,
+  "frozenset": frozenset,
+  "type": named_type,
+  "object": lambda args: decode_object(*args),
+  "items": lambda args: decode_items(*args),
+  "bytes": lambda v: base64.b64decode(v.encode("ascii")),
+  "complex": lambda v: complex(*v),
+  "Decimal": decimal.Decimal,
+  "Fraction": fractions.Fraction,
+  "datetime": lambda v: datetime.datetime.fromisoformat(v),
+  "date": lambda v: datetime.date.fromisoformat(v),
+  "time": lambda v: datetime.time.fromisoformat(v),
+  "timedelta": lambda v: datetime.timedelta(*v),
+  "range": lambda v: range(*v),
+  "array": lambda v: array.array(*v),
+  "ndarray": lambda v: numpy.array(v[1], dtype=v[0]),
+  }
+RAW = set(["dict", "type", "bytes", "Decimal", "Fraction", "datetime",
+           "date", "time", "array", "ndarray"])
+
+def decode(value):
+  """The reverse of encode()."""
+  t = type(value)
+  if t is list:
+    return [decode(i) for i in value]
+  elif t is not dict:
+    return value
+
+  ((tag, args),) = value.items()
+  if tag not in RAW:
+    args = decode(args)
+  decoder = DECODERS.get(tag)
+  if decoder is not None:
+    return decoder(args)
+
+  cls = named_type(tag)
+  if not issubclass(cls, Comparator):
+    raise TypeError("%s is not a comparator" % tag)
+  return cls(*args)
+
+def dumps(template):
+  """
+  Returns: template as JSON text that loads() turns back into the template.
+    This works for templates made of the builtin types, classes, objects
+    of other classes and the comparators in deep. Other comparators need
+    an arguments() method. Functions and other callables can't be dumped,
+    nor can classes that can't be imported by name.
+  """
+  return json.dumps(encode(template, set()), separators=(",", ":"))
+
+def loads(text, tolerance=None):
+  """The reverse of dumps(). Classes are imported by name and objects are
+  built without calling __init__(), as pickle does, so only load text that
+  you trust.
+
+  Returns: the template, compiled, see compile().
+  """
+  return compile(decode(json.loads(text)), tolerance)
+
+def dump(template, f):
+  """Write template to the file f, see dumps()."""
+  f.write(dumps(template))
+
+def load(f, tolerance=None):
+  """Read a template written by dump() from the file f, see loads()."""
+  return loads(f.read(), tolerance)
+
+def infer(sample):
+  """Make a template from an example of the data it should match. Scalars
+  are compared by type, dicts key by key, tuples position by position,
+  lists element by element against a template that fits all of the
+  sample's elements, and objects attribute by attribute. Keys that only
+  some of the dicts in a list have are Optional. The result is a starting
+  point, e.g. replace an InstanceOf(str) with a Re.
+  """
+  t = type(sample)
+  if t is dict:
+    return dict((k, infer(v)) for (k, v) in sample.items())
+  elif t is tuple:
+    return tuple(infer(i) for i in sample)
+  elif t is list:
+    template = None
+    for i in sample:
+      template = merge(template, infer(i))
+    if template is None:
+      return InstanceOf(list)
+    return And(InstanceOf(list), ArrayValues(template))
+
+  wrapper = WRAPPER_CACHE.get(t) or find_wrapper(t)
+  if wrapper is Object or wrapper is Fields:
+    attrs = {}
+    for name in fields_of(t) or ("__dict__",):
+      if name == "__dict__":
+        attrs.update(vars(sample))
+      elif hasattr(sample, name):
+        attrs[name] = getattr(sample, name)
+    return And(InstanceOf(t),
+               Attrs(dict((k, infer(v)) for (k, v) in attrs.items())))
+
+  return InstanceOf(t)
+
+def merge(t1, t2):
+  """Used by infer().
+
+  Returns: a template that matches anything t1 or t2 matches.
+  """
+  if t1 is None:
+    return t2
+
+  (c1, c2) = (type(t1), type(t2))
+  if c1 is dict and c2 is dict:
+    # the keys that aren't in both are Optional
+    merged = {}
+    for k in itertools.chain(t1, (k for k in t2 if k not in t1)):
+      optional = k not in t1 or k not in t2
+      template = None
+      for t in (t1, t2):
+        if k in t:
+          v = t[k]
+          if type(v) is Optional:
+            (optional, v) = (True, v.value)
+          template = merge(template, v)
+      merged[k] = Optional(template) if optional else template
+    return merged
+  elif c1 is tuple and c2 is tuple:
+    if len(t1) == len(t2):
+      return tuple(merge(i1, i2) for (i1, i2) in zip(t1, t2))
+  elif c1 is And and c2 is And and t1.conds[0].value is t2.conds[0].value:
+    if len(t1.conds) == 1:
+      return t2
+    elif len(t2.conds) == 1:
+      return t1
+    (v1, v2) = (t1.conds[1].value, t2.conds[1].value)
+    if type(t1.conds[1]) is ArrayValues:
+      return And(t1.conds[0], ArrayValues(merge(v1, v2)))
+    elif set(v1) == set(v2):
+      return And(t1.conds[0], Attrs(dict((k, merge(v1[k], v2[k]))
+                                         for k in v1)))
+
+  # fall back to checking the type
+  types = []
+  for t in (t1, t2):
+    if type(t) is InstanceOf:
+      t = t.value
+    elif type(t) is And:
+      t = t.conds[0].value
+    else:
+      t = type(t)
+    for cls in (t if type(t) is tuple else (t,)):
+      if cls not in types:
+        types.append(cls)
+  if len(types) == 1:
+    return InstanceOf(types[0])
+  return InstanceOf(tuple(types))
+
+# The builtin types, see register_wrapper()
+for t in EQUAL_TYPES + (type(None), type(Ellipsis), bytes, bytearray, complex,
+                        memoryview, range, slice, decimal.Decimal,
+                        fractions.Fraction, datetime.date, datetime.time,
+                        datetime.timedelta, datetime.tzinfo,
+                        collections.deque):
+  register_wrapper(t, Equal)
+register_wrapper(array.array, ArrayEqual)
+if numpy is not None:
+  register_wrapper(numpy.ndarray, wrap_ndarray)
+register_wrapper(list, List)
+register_wrapper(tuple, Tuple)
+register_wrapper(set, Set)
+register_wrapper(frozenset, Frozenset)
+register_wrapper(dict, Dict)
+register_wrapper(type, Is)
+register_wrapper(object, Object)
@@ -0,0 +1,81 @@
+# Copyright 2008 Fergal Daly <fergal@esatclear.ie>
+
+# This file is part of deep.py.
+#
+# deep.py is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation; either version 2.1 of the License.
+#
+# deep.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with deep.py; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Compare items in an asyncio program without holding up the event loop.
+This needs python 3.6 or later and is not imported by deep itself.
+
+A comparison gives the loop a turn every so often, so a large item doesn't
+stop other tasks from running. Items that are known to be very large can
+be compared in an executor instead.
+
+  async for (n, found) in deep.aio.adiff_stream(records, template):
+    print("record %i: %s" % (n, found.render_full()))
+"""
+
+import asyncio
+import functools
+
+import deep
+
+# The number of pairs compared between turns of the event loop
+PAUSE = 1000
+
+async def adiff(item, template, pause=PAUSE, on_error="raise"):
+  """Like deep.diff() but gives the event loop a turn after every pause
+  pairs that are compared.
+
+  Returns: None if they match or the Comparison that found a difference,
+    see deep.outcome().
+  """
+  comp = deep.Comparison(on_error=on_error)
+  for found in comp.walk(item, template, pause=pause):
+    if found is not deep.Pause:
+      return comp
+    await asyncio.sleep(0)
+
+  return deep.outcome(comp, True)
+
+async def adiff_stream(items, template, pause=PAUSE, offload=None,
+                       executor=None, tolerance=None, on_error="raise"):
+  """Compare each item from an async iterable against template. The
+  template is compiled once.
+
+  Arguments:
+    pause: see adiff().
+    offload: a function that returns true for the items to compare in
+      executor rather than on the event loop, e.g.
+      lambda record: len(record["lines"]) > 10000
+    executor: a concurrent.futures executor for the offloaded items, by
+      default the loop's.
+    tolerance, on_error: see deep.diff().
+  Generates: (n, Comparison) for each item that doesn't match, n counts the
+    items from 0.
+  """
+  template = deep.compile(template, tolerance)
+  loop = asyncio.get_event_loop()
+
+  n = 0
+  async for item in items:
+    if offload is not None and offload(item):
+      found = await loop.run_in_executor(
+        executor,
+        functools.partial(deep.diff, item, template, on_error=on_error))
+    else:
+      found = await adiff(item, template, pause, on_error)
+    if found is not None:
+      yield (n, found)
+    n += 1
@@ -0,0 +1,477 @@
+# Copyright 2008 Fergal Daly <fergal@esatclear.ie>
+
+# This file is part of deep.py.
+#
+# deep.py is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation; either version 2.1 of the License.
+#
+# deep.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with deep.py; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Compare JSON text against a template while reading it, without loading
+it all into memory.
+
+Lists and dicts in the JSON that the template compares with List, Dict,
+ArrayValues or DictValues are never built, their elements are compared as
+they are read. Values compared with Ignore are skipped. Anything else is
+loaded and compared as usual, so a template like And(...) or EqSet(...)
+loads the whole of the value it's compared with. Differences are the same
+as diff() would find for the loaded JSON, with the same paths, and so is the
+DeepException raised when a comparator raises an exception, though it is
+raised only once the list or dict it is in has been read.
+
+  found = deep.stream.diff(open("export.json", "rb"), template)
+
+  for (n, found) in deep.stream.diff_ndjson(open("export.ndjson", "rb"),
+                                            template):
+    print("record %i: %s" % (n, found.render_full()))
+"""
+
+import codecs
+import io
+import json
+import re
+
+import deep
+
+# A token, after any whitespace. Only the first group that matches is set.
+TOKEN = re.compile(r'[ \t\n\r]*(?:([{}\[\]:,])|'
+                   r'("(?:[^"\\]|\\.)*")|'
+                   r'(-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?)|'
+                   r'(true|false|null))')
+SPACE = re.compile(r'[ \t\n\r]*')
+# The start of a token that might continue past the end of the buffer
+PARTIAL = re.compile(r'[ \t\n\r]*["\-0-9tfn]')
+NUMBER_CHARS = "0123456789.eE+-"
+# Anything up to the next bracket that isn't in a string
+SKIP = re.compile(r'[^"\[\]{}]*(?:"(?:[^"\\]|\\.)*"[^"\[\]{}]*)*')
+LITERALS = {"true": True, "false": False, "null": None}
+
+class Tokens(object):
+  """Splits the JSON text read from a file into tokens, holding only a
+  little more than the current token in memory. Tokens are (kind, value)
+  where kind is one of {}[]:, or "value", or None at the end of the text."""
+  chunk_size = 1 << 16
+
+  def __init__(self, source):
+    """
+    Arguments:
+      source: a file or anything else with a read(size) method (e.g. an
+        mmap) returning text or UTF-8 encoded bytes, or the text or bytes
+        themselves.
+    """
+    if isinstance(source, bytes):
+      source = io.BytesIO(source)
+    elif isinstance(source, str):
+      source = io.StringIO(source)
+    self.read = source.read
+    self.decoder = None
+    self.buf = ""
+    self.pos = 0
+    # the number of characters dropped from the front of buf
+    self.offset = 0
+    self.eof = False
+    self.peeked = None
+
+  def fill(self):
+    """Read more text, at least as much as is unused in the buffer so
+    that long tokens don't take too many reads."""
+    data = self.read(max(self.chunk_size, len(self.buf) - self.pos))
+    if isinstance(data, bytes):
+      if self.decoder is None:
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+      data = self.decoder.decode(data, not data)
+    if not data:
+      self.eof = True
+
+    self.offset += self.pos
+    self.buf = self.buf[self.pos:] + data
+    self.pos = 0
+
+  def error(self, msg):
+    raise ValueError("%s at character %i" % (msg, self.offset + self.pos))
+
+  def peek(self):
+    """
+    Returns: the next token, without consuming it.
+    """
+    if self.peeked is None:
+      self.peeked = self.scan()
+
+    return self.peeked
+
+  def next(self):
+    """
+    Returns: the next token.
+    """
+    token = self.peek()
+    self.peeked = None
+
+    return token
+
+  def scan(self):
+    while True:
+      buf = self.buf
+      m = TOKEN.match(buf, self.pos)
+      if m is not None:
+        end = m.end()
+        # a number might continue in text not read yet, e.g. 1 then .5
+        if self.eof or end < len(buf) and \
+           (m.group(3) is None or buf[end] not in NUMBER_CHARS):
+          break
+      elif self.eof:
+        if SPACE.match(buf, self.pos).end() == len(buf):
+          return (None, None)
+        self.error("Invalid JSON")
+      elif not PARTIAL.match(buf, self.pos) and \
+           SPACE.match(buf, self.pos).end() < len(buf):
+        self.error("Invalid JSON")
+      self.fill()
+
+    self.pos = m.end()
+    (punct, string, number, literal) = m.groups()
+    if punct is not None:
+      return (punct, None)
+    elif string is not None:
+      if "\\" in string:
+        value = json.loads(string)
+      else:
+        value = string[1:-1]
+    elif number is not None:
+      if "." in number or "e" in number or "E" in number:
+        value = float(number)
+      else:
+        value = int(number)
+    else:
+      value = LITERALS[literal]
+
+    return ("value", value)
+
+  def expect(self, kind):
+    token = self.next()
+    if token[0] != kind:
+      self.error("Expected %s" % (kind or "end of the text"))
+
+    return token
+
+  def elements(self):
+    """Reads a list, generating the index of each element. The caller must
+    consume each element before asking for the next."""
+    self.expect("[")
+    if self.peek()[0] == "]":
+      self.next()
+      return
+
+    i = 0
+    while True:
+      yield i
+      i += 1
+      kind = self.next()[0]
+      if kind == "]":
+        return
+      elif kind != ",":
+        self.error("Expected , or ]")
+
+  def keys(self):
+    """Reads a dict, generating each key. The caller must consume each value
+    before asking for the next key."""
+    self.expect("{")
+    if self.peek()[0] == "}":
+      self.next()
+      return
+
+    while True:
+      (kind, key) = self.next()
+      if kind != "value" or not isinstance(key, str):
+        self.error("Expected a key")
+      self.expect(":")
+      yield key
+      kind = self.next()[0]
+      if kind == "}":
+        return
+      elif kind != ",":
+        self.error("Expected , or }")
+
+  def load(self):
+    """
+    Returns: the next value, loaded into python objects like json.load().
+    """
+    kind = self.peek()[0]
+    if kind == "[":
+      return [self.load() for i in self.elements()]
+    elif kind == "{":
+      item = {}
+      for key in self.keys():
+        item[key] = self.load()
+      return item
+    else:
+      return self.expect("value")[1]
+
+  def skip(self):
+    """Reads the next value without building it. The insides of skipped
+    lists and dicts are only checked for balanced brackets."""
+    kind = self.next()[0]
+    if kind not in ("[", "{"):
+      if kind != "value":
+        self.error("Expected a value")
+      return
+
+    depth = 1
+    while depth:
+      buf = self.buf
+      end = SKIP.match(buf, self.pos).end()
+      self.pos = end
+      if end == len(buf) or buf[end] == '"':
+        # the end of the buffer or of a string is still to be read
+        if self.eof:
+          self.error("Unexpected end of the text")
+        self.fill()
+        continue
+
+      if buf[end] in "[{":
+        depth += 1
+      else:
+        depth -= 1
+      self.pos = end + 1
+
+class Matcher(object):
+  """Compares the values read from a Tokens against compiled templates."""
+  def __init__(self, tokens):
+    self.tokens = tokens
+    # loaded scalars are compared with this, its stack also holds the
+    # (item, comparator) pairs leading to the current value, where the items
+    # of the lists and dicts that are never built are None
+    self.comparison = deep.Comparison()
+    self.stack = self.comparison.stack
+    # id(Dict): {key: (position, IndexedElem)}
+    self.indexes = {}
+
+  def match(self, template):
+    """Reads the next value and compares it against template.
+
+    Returns: None if they match or a Difference.
+    """
+    tokens = self.tokens
+    t = type(template)
+    if t is deep.Ignore:
+      tokens.skip()
+      return None
+    elif t is deep.Optional:
+      # only matters to the Dict it's in, see match_dict()
+      stack = self.stack
+      stack.append((None, template))
+      try:
+        return self.match(template.value)
+      finally:
+        stack.pop()
+
+    kind = tokens.peek()[0]
+    if kind == "{":
+      if t is deep.Dict:
+        return self.match_dict(template)
+      elif t is deep.DictValues:
+        return self.match_values(template, tokens.keys(), True)
+    elif kind == "[":
+      if t is deep.List:
+        return self.match_list(template)
+      elif t is deep.ArrayValues:
+        return self.match_values(template, tokens.elements())
+
+    return self.compare(tokens.load(), template)
+
+  def compare(self, item, template):
+    """Compare a loaded item in the usual way."""
+    stack = self.stack
+    depth = len(stack)
+    if type(item) in deep.UNCACHED_TYPES:
+      comp = self.comparison
+    else:
+      # a new comparison, so that the cache doesn't keep item alive
+      comp = deep.Comparison()
+      comp.stack = stack
+
+    try:
+      if comp.descend(item, template):
+        return None
+    except deep.DeepException as error:
+      # the stack is shared with the lists and dicts still being read, so
+      # keep a copy of the path
+      error.comp = deep.Difference(stack[:])
+      del stack[depth:]
+      raise
+
+    found = deep.Difference(stack[:])
+    del stack[depth:]
+    return found
+
+  def match_elem(self, elem):
+    """Reads the next value and compares it against the template inside
+    elem, with elem on the stack.
+
+    Returns: None if they match, a Difference or the DeepException raised by
+      a comparator. The value has been read either way, so the caller can
+      check what diff() would check before the element, e.g. the keys of a
+      dict, before raising it.
+    """
+    stack = self.stack
+    stack.append((None, elem))
+    try:
+      return self.match(elem.value)
+    except deep.DeepException as error:
+      return error
+    finally:
+      stack.pop()
+
+  def match_dict(self, template):
+    tokens = self.tokens
+    stack = self.stack
+    index = self.indexes.get(id(template))
+    if index is None:
+      index = self.indexes[id(template)] = dict(
+        (elem.index, (n, elem)) for (n, elem) in enumerate(template.conds))
+
+    # json.load() keeps the last value for a key, so each value replaces
+    # the result of any earlier one with the same key. Dict compares the
+    # elements in the template's order, so the first difference or
+    # exception in that order is kept.
+    results = {}
+    keys = []
+    stack.append((None, template))
+    for key in tokens.keys():
+      keys.append(key)
+      entry = index.get(key)
+      if entry is not None:
+        results[entry[0]] = self.match_elem(entry[1])
+      else:
+        tokens.skip()
+    found = None
+    for n in sorted(results):
+      if results[n] is not None:
+        found = results[n]
+        break
+
+    try:
+      if len(keys) != len(index) or set(keys) != set(index):
+        # the keys are checked before the elements, those of Optional values
+        # only if they are there
+        value = template.value
+        seen = set(keys)
+        required = [k for k in value
+                    if k in seen or not isinstance(value[k], deep.Optional)]
+        if seen != set(required):
+          found = self.compare(dict.fromkeys(keys), deep.HasKeys(required))
+    finally:
+      stack.pop()
+
+    if isinstance(found, deep.DeepException):
+      raise found
+    return found
+
+  def match_list(self, template):
+    tokens = self.tokens
+    stack = self.stack
+    elems = template.conds[2:]
+
+    found = None
+    count = 0
+    stack.append((None, template))
+    for i in tokens.elements():
+      if found is None and i < len(elems):
+        found = self.match_elem(elems[i])
+      else:
+        tokens.skip()
+      count += 1
+
+    try:
+      if count != len(elems):
+        # the length is checked before the elements
+        length = template.conds[1]
+        stack.append((None, length))
+        found = self.compare(count, length.value)
+        stack.pop()
+    finally:
+      stack.pop()
+
+    if isinstance(found, deep.DeepException):
+      raise found
+    return found
+
+  def match_values(self, template, indices, keyed=False):
+    """Compares each element or value read against ArrayValues or
+    DictValues.
+
+    Arguments:
+      keyed: true if indices are the keys of a dict. json.load() keeps the
+        last value for a key, in the place of the first, so each value is
+        compared and replaces the result of any earlier one with its key.
+    """
+    tokens = self.tokens
+    stack = self.stack
+    value = template.value
+
+    found = None
+    # {key: result} and the keys in the order they were first read
+    (results, order) = ({}, [])
+    stack.append((None, template))
+    stack.append((None, deep.Slice(value, None)))
+    for i in indices:
+      if keyed:
+        if i not in results:
+          order.append(i)
+        results[i] = self.match_elem(deep.IndexedElem(i, value))
+      elif found is None:
+        found = self.match_elem(deep.IndexedElem(i, value))
+      else:
+        tokens.skip()
+    stack.pop()
+    stack.pop()
+    for i in order:
+      if results[i] is not None:
+        found = results[i]
+        break
+
+    # the rest of the value is read before raising
+    if isinstance(found, deep.DeepException):
+      raise found
+    return found
+
+def diff(source, template):
+  """Compare the JSON text read from source against template, like
+  deep.diff(json.load(source), template).
+
+  Arguments:
+    source: see Tokens
+  Returns: None if they match or a Difference.
+  """
+  tokens = Tokens(source)
+  found = Matcher(tokens).match(deep.compile(template))
+  tokens.expect(None)
+
+  return found
+
+def diff_ndjson(source, template):
+  """Compare each JSON value in source, e.g. one per line, against
+  template.
+
+  Arguments:
+    source: see Tokens
+  Returns: a generator of (n, Difference) for each value that doesn't match,
+    n counts the values from 0.
+  """
+  tokens = Tokens(source)
+  matcher = Matcher(tokens)
+  template = deep.compile(template)
+
+  n = 0
+  while tokens.peek()[0] is not None:
+    found = matcher.match(template)
+    if found is not None:
+      yield (n, found)
+    n += 1
@@ -0,0 +1,213 @@
+#! /usr/bin/python
+
+"""Benchmarks for deep.
+
+Run with no arguments to time each benchmark and compare it with the
+baseline in deep_bench.json. Any benchmark that is more than --tolerance
+slower than its baseline is reported and the exit status is 1. Baselines
+depend on the machine, so run with --save on a clean tree to record new
+ones before comparing a change.
+"""
+
+from __future__ import print_function
+from builtins import range
+from builtins import object
+
+import copy
+import json
+import optparse
+import os
+import sys
+import time
+
+import deep as d
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "deep_bench.json")
+
+try:
+  timer = time.perf_counter
+except AttributeError:
+  timer = time.time
+
+benchmarks = []
+
+def benchmark(setup):
+  """Register a benchmark. setup() builds the data and returns the function
+  to time."""
+  benchmarks.append((setup.__name__, setup))
+  return setup
+
+def check(found, expected=None):
+  """Make sure a benchmark measured what it was supposed to."""
+  if found is not expected:
+    raise AssertionError("expected %s, got %s" % (expected, found))
+
+@benchmark
+def wide_list():
+  items = list(range(100000))
+  template = list(range(100000))
+  return lambda: check(d.diff(items, template))
+
+@benchmark
+def wide_dict():
+  items = dict(("key%i" % i, i) for i in range(50000))
+  template = dict(items)
+  return lambda: check(d.diff(items, template))
+
+@benchmark
+def records():
+  items = [{"id": i, "name": "n%i" % i, "tags": [1, 2, 3], "x": float(i)}
+           for i in range(10000)]
+  template = copy.deepcopy(items)
+  return lambda: check(d.diff(items, template))
+
+@benchmark
+def compiled_records():
+  items = [{"id": i, "name": "n%i" % i, "tags": [1, 2, 3], "x": float(i)}
+           for i in range(10000)]
+  template = d.compile(d.ArrayValues({"id": d.InstanceOf(int),
+                                      "name": d.Re("^n"),
+                                      "tags": [1, 2, 3],
+                                      "x": d.InstanceOf(float)}))
+  return lambda: check(d.diff(items, template))
+
+@benchmark
+def deep_nesting():
+  def nest(n):
+    item = {"v": 0}
+    for i in range(n):
+      item = {"next": item}
+    return item
+  (items, template) = (nest(5000), nest(5000))
+  return lambda: check(d.diff(items, template))
+
+@benchmark
+def cyclic():
+  def ring(n):
+    nodes = [[i] for i in range(n)]
+    for (i, node) in enumerate(nodes):
+      node.append(nodes[(i + 1) % n])
+    return nodes[0]
+  (items, template) = (ring(20000), ring(20000))
+  return lambda: check(d.diff(items, template))
+
+@benchmark
+def big_set():
+  items = set((i, "s%i" % i) for i in range(20000))
+  template = set(items)
+  return lambda: check(d.diff(items, template))
+
+@benchmark
+def set_of_comparators():
+  items = set("s%i" % i for i in range(300))
+  template = d.EqSet([d.Re("^s%i$" % i) for i in range(300)])
+  return lambda: check(d.diff(items, template))
+
+class Node(object):
+  def __init__(self, i, children):
+    self.i = i
+    self.name = "node%i" % i
+    self.children = children
+
+@benchmark
+def objects():
+  def tree(n):
+    return [Node(i, [Node(j, []) for j in range(5)]) for i in range(n)]
+  (items, template) = (tree(3000), tree(3000))
+  return lambda: check(d.diff(items, template))
+
+@benchmark
+def attrs():
+  items = [Node(i, []) for i in range(10000)]
+  template = d.ArrayValues(d.Attrs(name=d.Re("^node"), children=[]))
+  return lambda: check(d.diff(items, template))
+
+@benchmark
+def regex():
+  items = ["item %i" % i for i in range(50000)]
+  template = d.ArrayValues(d.Re(r"^item \d+$"))
+  return lambda: check(d.diff(items, template))
+
+@benchmark
+def render_failure():
+  big = list(range(100000))
+  items = {"a": {"b": [big, big]}}
+  template = {"a": {"b": [big, "x"]}}
+  found = d.diff(items, template)
+  def run():
+    for i in range(1000):
+      found.render_full()
+  return run
+
+@benchmark
+def every_difference():
+  items = [{"id": i, "v": i} for i in range(20000)]
+  template = d.ArrayValues({"id": d.Ignore(), "v": 0})
+  def run():
+    for difference in d.iter_diffs(items, template):
+      difference.render_full()
+  return run
+
+def measure(run, repeat):
+  """
+  Returns: the fastest of repeat runs.
+  """
+  best = None
+  for i in range(repeat):
+    start = timer()
+    run()
+    taken = timer() - start
+    if best is None or taken < best:
+      best = taken
+  return best
+
+def main(args):
+  parser = optparse.OptionParser(usage="%prog [options] [name...]")
+  parser.add_option("--save", action="store_true",
+                    help="record the times as the new baseline")
+  parser.add_option("--baseline", default=BASELINE,
+                    help="the baseline file [%default]")
+  parser.add_option("--repeat", type="int", default=5,
+                    help="time each benchmark this many times [%default]")
+  parser.add_option("--tolerance", type="float", default=0.25,
+                    help="how much slower than the baseline is a regression "
+                    "[%default]")
+  (options, names) = parser.parse_args(args)
+
+  baseline = {}
+  if os.path.exists(options.baseline):
+    with open(options.baseline) as f:
+      baseline = json.load(f)
+
+  times = {}
+  regressions = []
+  for (name, setup) in benchmarks:
+    if names and name not in names:
+      continue
+    taken = times[name] = round(measure(setup(), options.repeat), 4)
+    base = baseline.get(name)
+    if base:
+      change = taken / base - 1
+      note = "%+.0f%%" % (change * 100)
+      if change > options.tolerance:
+        regressions.append(name)
+        note += " REGRESSION"
+    else:
+      note = "no baseline"
+    print("%-20s %8.4fs  %s" % (name, taken, note))
+
+  if options.save:
+    baseline.update(times)
+    with open(options.baseline, "w") as f:
+      json.dump(baseline, f, indent=2, sort_keys=True)
+      f.write("\n")
+    print("saved to %s" % options.baseline)
+  elif regressions:
+    print("slower than the baseline: %s" % ", ".join(regressions))
+    return 1
+
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
@@ -19,10 +19,19 @@
 
 from builtins import str
 from builtins import object
+import array
+import collections
+import copy
+import datetime
+import decimal
+import io
+import json
+import multiprocessing.pool
 import re
 import unittest
 
 import deep as d
+import deep.stream
 
 E=True
 N=False
@@ -115,6 +124,25 @@ class DeepTest(unittest.TestCase):
                "1 matching element(s), extra: [1], missing: [2]",
                "2 matching element(s)",
                "not eqset"),
+             E([[1], 2, [3]], d.EqSet([2, [3], [1]]), "unhashable eqset"),
+             N([[1], 2, "a"], d.EqSet(["a", [3], [1]]), "x as a set (==)",
+               "2 matching element(s), extra: [2], missing: [[3]]",
+               "3 matching element(s)",
+               "not unhashable eqset"),
+             E(["ab", "a"], d.EqSet([d.Re("a"), d.Re("b")]),
+               "eqset with comparators"),
+             E([1, [2], 1, "ab", "a"], d.Bag([d.Re("a"), 1, [2], d.Re("b"), 1]),
+               "bag"),
+             N([1, [2], "ab", "a"], d.Bag([d.Re("a"), 1, [2], d.Re("b"), 1]),
+               "x as a bag",
+               "4 matching element(s), extra: [], missing: [1]",
+               "5 matching element(s)",
+               "not bag"),
+             N(["ab", "a", "a"], d.Bag([d.Re("a"), d.Re("b")]),
+               "x as a bag",
+               "2 matching element(s), extra: ['a'], missing: []",
+               "2 matching element(s)",
+               "not bag with comparators"),
              E({"a" : 0, "b" : 1}, d.IndexedElem("b", 1), "Dict['a']"),
              N({"a" : 0, "b" : 1}, d.IndexedElem("a", 1), "x['a']", "0", "1",
                "Dict['b']"),
@@ -230,11 +258,1135 @@ class DeepExc(unittest.TestCase):
       if not re.search(pat, str(ex)):
         self.fail("exception didn't match '%s':\n%s" % (pat, ex))
 
+class CompileTest(unittest.TestCase):
+  def runTest(self):
+    template = {"a": [1, d.Re("b")], "c": o2, "d": None}
+    compiled = d.compile(template)
+    self.assertTrue(isinstance(compiled, d.Comparator))
+
+    good = {"a": [1, "abc"], "c": o, "d": None}
+    self.assertEqual(None, compiled.diff(good))
+    self.assertTrue(compiled.matches(good))
+
+    res = compiled.diff({"a": [1, "xyz"], "c": o, "d": None})
+    self.assertEqual("x['a'][1]", res.render_path())
+    self.assertEqual("something matching 'b'", res.render_expected())
+    self.assertFalse(compiled.matches({"a": [1, "xyz"], "c": o, "d": None}))
+
+    res = compiled.diff({"a": [1, "abc"], "c": noto, "d": None})
+    self.assertEqual("x['c'].__dict__['an_attr2']", res.render_path())
+
+    # later changes to the template don't affect the compiled version
+    template["a"].append(2)
+    self.assertTrue(compiled.matches(good))
+    s = set([1, 2])
+    records = [{"id": 1}]
+    compiled = d.compile({"s": s, "b": d.Bag(records), "e": {"a": 1}})
+    s.add(3)
+    records[0]["id"] = 2
+    self.assertEqual(None, compiled.diff({"s": set([1, 2]), "b": [{"id": 1}],
+                                          "e": {"a": 1}}))
+
+    # it would hide the builtin
+    self.assertFalse("compile" in d.__all__)
+
+    # circular templates stay circular
+    circ = [1]
+    circ.append(circ)
+    other = [1]
+    other.append(other)
+    self.assertTrue(d.compile(circ).matches(other))
+
+class MatchesTest(unittest.TestCase):
+  def runTest(self):
+    self.assertTrue(d.matches([1, {"a": o}], [1, {"a": o2}]))
+    self.assertFalse(d.matches([1, {"a": o}], [1, {"a": noto}]))
+    self.assertTrue(d.matches(["abc"], d.ArrayValues(d.Re("b"))))
+    self.assertFalse(d.matches(["abc", "a"], d.ArrayValues(d.Re("b"))))
+
+    # circular data is handed over to the full comparison
+    circ = [1]
+    circ.append(circ)
+    other = [1]
+    other.append(other)
+    self.assertTrue(d.matches(circ, d.compile(other)))
+
+    self.assertRaises(d.DeepException,
+                      d.matches, [0, 1], d.IndexedElem(2, None))
+
+    # shared parts are only compared once
+    (x, y) = ([1], [1])
+    for i in range(40):
+      (x, y) = ([x, x], [y, y])
+    self.assertTrue(d.matches(x, y))
+    self.assertFalse(d.matches(x, [y, [y, [1]]]))
+
+    # deeper than max_depth
+    (x, y) = ([], [])
+    for i in range(3000):
+      (x, y) = ([x], [y])
+    self.assertTrue(d.matches(x, y))
+    self.assertFalse(d.matches(x, [[y]]))
+
+class DictTest(unittest.TestCase):
+  def runTest(self):
+    template = d.Dict({"a": 0, "b": [1]})
+    ordered = collections.OrderedDict([("b", [1]), ("a", 0)])
+    self.assertEqual(None, d.diff(ordered, template))
+
+    res = d.diff({"b": [1], "c": 0}, template)
+    self.assertEqual("x.keys() as a set (==)", res.render_path())
+    self.assertEqual("1 matching element(s), extra: ['c'], missing: ['a']",
+                     res.render_actual())
+
+    # elements are reused between comparisons but not once replaced
+    template.value["b"] = [2]
+    res = d.diff(ordered, template)
+    self.assertEqual("x['b'][0]", res.render_path())
+
+    # Optional keys may be missing
+    template = {"a": 0, "b": d.Optional([1])}
+    self.assertEqual(None, d.diff({"a": 0}, template))
+    self.assertEqual(None, d.diff({"a": 0, "b": [1]}, template))
+    self.assertEqual("x['b'][0]",
+                     d.diff({"a": 0, "b": [2]}, template).render_path())
+    res = d.diff({"b": [1]}, template)
+    self.assertEqual("1 matching element(s), extra: [], missing: ['a']",
+                     res.render_actual())
+    res = d.diff({"a": 0, "c": 1}, template)
+    self.assertEqual("1 matching element(s), extra: ['c'], missing: []",
+                     res.render_actual())
+
+class AttrsTest(unittest.TestCase):
+  def runTest(self):
+    class Point(object):
+      def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+    points = [Point(i, 0) for i in range(3)]
+    attrs = d.Attrs([("x", d.Ignore()), ("y", 0)])
+    template = d.ArrayValues(attrs)
+    self.assertEqual(None, d.diff(points, template))
+
+    # attributes are reused between comparisons but not once replaced
+    (x, y) = attrs.conditions()
+    (x2, y2) = attrs.conditions()
+    self.assertTrue(x2 is x and y2 is y)
+    attrs.value[1] = ("y", 1)
+    (x2, y2) = attrs.conditions()
+    self.assertTrue(x2 is x and y2 is not y)
+    self.assertEqual("x[0].y", d.diff(points, template).render_path())
+
+class BagTest(unittest.TestCase):
+  def runTest(self):
+    # only the records with the same id are compared, so this is quick
+    items = [{"id": i, "name": "n%i" % i} for i in range(5000)]
+    items.reverse()
+    template = d.Bag([{"id": i, "name": d.Re("^n")} for i in range(5000)])
+    self.assertEqual(None, d.diff(items, template))
+
+    items[0] = {"id": 4999, "name": "x"}
+    res = d.diff(items, template)
+    self.assertEqual("4999 matching element(s), "
+                     "extra: [{'id': 4999, 'name': 'x'}], "
+                     "missing: [{'id': 4999, 'name': Re('^n')}]",
+                     res.render_actual())
+
+    # items that can't be looked up by their values are compared with all
+    loose = [collections.OrderedDict([("id", 1), ("name", "n")]),
+             {"id": decimal.Decimal(2), "name": "n"}, {"id": 2}, [1]]
+    template = d.Bag([{"id": 2, "name": d.Re("n")},
+                      {"id": 1, "name": d.Re("n")}, {"id": 2}, [1]])
+    self.assertEqual(None, d.diff(loose, template))
+
+class FingerprintTest(unittest.TestCase):
+  def runTest(self):
+    prints = d.Fingerprints()
+    old = {"a": [1, 2.5, "x"], "b": (None, True), "c": set([1, 2])}
+    new = {"a": [1, 2.5, "x"], "b": (None, True), "c": set([2, 1])}
+    self.assertEqual(prints.get(old), prints.get(new))
+    self.assertEqual(None, d.diff(old, new, fingerprints=prints))
+
+    new["a"][1] = 3
+    prints.forget(new["a"])
+    res = d.diff(old, new, fingerprints=prints)
+    self.assertEqual("x['a'][1]", res.render_path())
+
+    # forgetting a container forgets everything it's inside
+    old = {"cfg": {"a": [1, 2]}, "b": [3]}
+    new = {"cfg": {"a": [1, 2]}, "b": [3]}
+    self.assertEqual(None, d.diff(new, old, fingerprints=prints))
+    new["cfg"]["a"][1] = 5
+    prints.forget(new["cfg"]["a"])
+    res = d.diff(new, old, fingerprints=prints)
+    self.assertEqual("x['cfg']['a'][1]", res.render_path())
+    self.assertTrue(id(new["b"]) in prints.prints)
+
+    # the oldest are forgotten
+    prints = d.Fingerprints(maxsize=10)
+    items = [[i] for i in range(100)]
+    self.assertEqual(None, d.diff(items, [[i] for i in range(100)],
+                                  fingerprints=prints))
+    self.assertTrue(len(prints.prints) <= 10)
+    self.assertTrue(len(prints.parents) <= 10)
+
+    # different but equal, not skipped but still equal
+    self.assertNotEqual(prints.get([1]), prints.get([1.0]))
+    self.assertEqual(None, d.diff([1], [1.0], fingerprints=prints))
+
+    # unprintable
+    self.assertEqual(None, prints.get([float("nan")]))
+    self.assertEqual(None, prints.get([o]))
+    circ = [1]
+    circ.append(circ)
+    self.assertEqual(None, prints.get(circ))
+
+class DeepNestingTest(unittest.TestCase):
+  def runTest(self):
+    (l1, l2) = (None, None)
+    for i in range(5000):
+      l1 = {"v": i, "next": l1}
+      l2 = {"v": i, "next": l2}
+    l2["next"]["next"]["v"] = "x"
+
+    res = d.diff(l1, l2)
+    self.assertEqual("x['next']['next']['v']", res.render_path())
+    self.assertEqual("'x'", res.render_expected())
+    self.assertEqual(None, d.diff(l1, l1.copy()))
+
+    # compiled without recursion too
+    self.assertEqual(["x['next']['next']['v']", None],
+                     [res and res.render_path() for res in
+                      d.validate_many([l1, l2], l2, workers=1)])
+    # too deep to fingerprint but still compared
+    prints = d.Fingerprints()
+    self.assertEqual(None, d.diff(l1, l1.copy(), fingerprints=prints))
+    res = d.diff(l1, l2, fingerprints=prints)
+    self.assertEqual("x['next']['next']['v']", res.render_path())
+
+class IterDiffsTest(unittest.TestCase):
+  def runTest(self):
+    items = [{"a": 1, "b": [1, "y"]},
+             {"a": 2, "b": [1, "y"]},
+             {"a": 1, "b": [3, 2, 1]},
+             {"a": 1, "c": 2}]
+    template = d.ArrayValues({"a": 1, "b": [1, d.Re("x")]})
+    found = [(diff.render_path(), diff.render_expected(), diff.render_actual())
+             for diff in d.iter_diffs(items, template)]
+    self.assertEqual([("x[0]['b'][1]", "something matching 'x'", "'y'"),
+                      ("x[1]['a']", "1", "2"),
+                      ("x[1]['b'][1]", "something matching 'x'", "'y'"),
+                      ("len(x[2]['b'])", "2", "3"),
+                      ("x[3].keys() as a set (==)",
+                       "2 matching element(s)",
+                       "1 matching element(s), extra: ['c'], missing: ['b']"),
+                      ], found)
+
+    self.assertEqual(2, len(list(d.iter_diffs(items, template, max_diffs=2))))
+    self.assertEqual([], list(d.iter_diffs(items, items)))
+    self.assertEqual(["x.an_attr", "x.an_attr2"],
+                     [diff.render_path() for diff in
+                      d.iter_diffs(o, d.Attrs(an_attr=0, an_attr2=0))])
+
+    # a shared part that differs is reported down to the leaf each time
+    shared = {"a": 1}
+    self.assertEqual(["x[0]['a']", "x[1]['a']"],
+                     [diff.render_path() for diff in
+                      d.iter_diffs([shared, shared],
+                                   d.ArrayValues({"a": 2}))])
+
+class CacheTest(unittest.TestCase):
+  def runTest(self):
+    # plain circular templates don't need compile()
+    circ = [1]
+    circ.append(circ)
+    other = [1]
+    other.append(other)
+    self.assertEqual(None, d.diff(circ, other))
+    wrong = [2]
+    wrong.append(wrong)
+    self.assertEqual("x[0]", d.diff(circ, wrong).render_path())
+
+    shared = {"a": [1, 2]}
+    items = [shared, shared, shared]
+    c = d.Comparison()
+    self.assertTrue(c.descend(items, d.compile([{"a": [1, 2]}] * 3)))
+    stats = c.cache.stats()
+    self.assertEqual(2, stats["hits"])
+    self.assertEqual(stats["size"], stats["misses"])
+
+    items = [[i] for i in range(100)]
+    c = d.Comparison(cache_size=10)
+    self.assertTrue(c.descend(items, [[i] for i in range(100)]))
+    self.assertEqual(10, len(c.cache))
+    self.assertEqual(10, len(c.cache.items))
+
+    c = d.Comparison(cache_size=10)
+    self.assertFalse(c.descend(items, [[i] for i in range(99)] + [[0]]))
+    self.assertEqual("x[99][0]", c.render_path())
+    self.assertTrue(len(c.cache) <= 10)
+
+    # the pairs being compared aren't moved around as results are added,
+    # which made deep structures slow
+    (l1, l2) = (None, None)
+    for i in range(3000):
+      l1 = {"v": i, "next": l1}
+      l2 = {"v": i, "next": l2}
+    c = d.Comparison(cache_size=10)
+    self.assertTrue(c.descend(l1, l2))
+    self.assertEqual(10, len(c.cache))
+
+class ParallelDiffTest(unittest.TestCase):
+  def runTest(self):
+    items = [{"id": i, "tags": [i, "x%d" % i]} for i in range(500)]
+    template = [{"id": i, "tags": [i, d.Re("x")]} for i in range(500)]
+    self.assertEqual(None, d.parallel_diff(items, template, workers=2,
+                                           chunksize=50))
+
+    template[450]["tags"][1] = d.Re("y")
+    template[470]["id"] = -1
+    record = {"id": d.Ignore(), "tags": [d.InstanceOf(int), d.Re("x[0-9]$")]}
+    for (i1, i2) in ((items, template),
+                     (tuple(items), template),
+                     (items, template[:-1]),
+                     (items, d.ArrayValues(record)),
+                     (dict(enumerate(items)), dict(enumerate(template))),
+                     (dict(enumerate(items)), d.DictValues(record)),
+                     (dict(enumerate(items)), dict(enumerate(template[1:]))),
+                     ):
+      serial = d.diff(i1, i2)
+      parallel = d.parallel_diff(i1, i2, workers=2, chunksize=50)
+      self.assertEqual(serial.render_full(), parallel.render_full())
+
+    self.assertRaises(d.DeepException, d.parallel_diff, [[0]] * 100,
+                      d.ArrayValues(d.IndexedElem(1, 0)), workers=2,
+                      chunksize=10)
+
+class Strict(d.Equal):
+  """Equal but the types must match."""
+  __slots__ = ()
+
+  def equals(self, item, comp):
+    return type(item) is type(self.value) and self.value == item
+
+class Lower(d.Re):
+  """Re on the lowercased item."""
+  __slots__ = ()
+
+  def equals(self, item, comp):
+    return d.Re.equals(self, item.lower(), comp)
+
+class ArrayTest(unittest.TestCase):
+  def render(self, diff):
+    return [diff.render_path(), diff.render_expected(), diff.render_actual()]
+
+  def check(self):
+    xs = [float(i) for i in range(1000)]
+    ys = list(xs)
+    ys[777] += 1
+    self.assertEqual(None, d.diff(xs, d.ArrayEqual(list(xs))))
+    self.assertEqual(None, d.diff(array.array("d", xs), d.ArrayEqual(xs)))
+    self.assertEqual(["x[777]", "778.0", "777.0"],
+                     self.render(d.diff(xs, d.ArrayEqual(ys))))
+    self.assertEqual(["len(x)", "999", "1000"],
+                     self.render(d.diff(xs, d.ArrayEqual(ys[1:]))))
+    self.assertEqual("x", d.diff("abc", d.ArrayEqual(xs)).render_path())
+
+    near = [x * (1 + 1e-7) for x in xs]
+    self.assertEqual(None, d.diff(xs, d.ArrayNear(near)))
+    self.assertEqual(["x[777]", "778.0 (rtol=1e-05, atol=0.5)", "777.0"],
+                     self.render(d.diff(xs, d.ArrayNear(ys, atol=0.5))))
+    self.assertEqual(None, d.diff(xs, d.ArrayNear(ys, rtol=0, atol=1)))
+    nans = [1.0, float("nan")]
+    self.assertEqual("x[1]", d.diff(nans, d.ArrayNear(nans)).render_path())
+
+    self.assertEqual(None, d.diff(xs, d.ArrayValues(d.InRange(0, 999))))
+    self.assertEqual(["x[999]", "something between 0 and 998", "999.0"],
+                     self.render(d.diff(xs, d.ArrayValues(d.InRange(0, 998)))))
+    self.assertEqual(["x[2]", "something >= 0", "'a'"],
+                     self.render(d.diff([1, 2, "a"],
+                                        d.ArrayValues(d.InRange(0)))))
+    self.assertEqual(["x[1]", "x[2]"],
+                     [diff.render_path() for diff in
+                      d.iter_diffs([1, 2, 3, 1], d.ArrayValues(d.Equal(1)))])
+    self.assertEqual(["x[2]", "2 (rtol=1e-05, atol=1e-08)", "3"],
+                     self.render(d.compile(d.ArrayValues(d.Near(2))).diff(
+                       [2, 2.0000001, 3])))
+
+    # ints too big to be floats aren't rounded
+    big = 2 ** 53
+    for (items, template) in (
+        ([big + 1, 0.5], d.ArrayEqual([big, 0.5])),
+        ([big + 1], d.ArrayValues(d.Equal(float(big)))),
+        ([float(big), 1], d.ArrayValues(d.Equal(big + 1))),
+        ([big + 1, 1], d.ArrayValues(d.InRange(high=float(big))))):
+      self.assertEqual("x[0]", d.diff(items, template).render_path())
+    self.assertEqual(None, d.diff([big, 0.5], d.ArrayEqual([float(big), 0.5])))
+
+    # subclasses that only override equals() aren't checked in one pass
+    self.assertEqual("x[1]", d.diff([1, 1.0], d.ArrayValues(Strict(1))
+                                    ).render_path())
+    self.assertEqual(None, d.diff(["A", "a"], d.ArrayValues(Lower("^a$"))))
+
+  def runTest(self):
+    self.check()
+    numpy = d.numpy
+    d.numpy = None
+    try:
+      self.check()
+    finally:
+      d.numpy = numpy
+
+    if numpy is not None:
+      a = numpy.arange(10) / 10.0
+      self.assertEqual(None, d.diff(a, d.ArrayNear(list(a))))
+      found = d.diff(a, d.ArrayValues(d.InRange(high=0.8)))
+      self.assertEqual("x[9]", found.render_path())
+      # numpy's == gives numpy.bool_, not False
+      self.assertEqual("x[1]", d.diff(numpy.array([1, 2.5]),
+                                      d.ArrayEqual([1, 2])).render_path())
+      self.assertNotEqual(None, d.diff(numpy.float64(2.5), 2))
+
+class NearTest(unittest.TestCase):
+  def runTest(self):
+    self.assertEqual(None, d.diff(1.000001, d.Near(1.0)))
+    self.assertEqual(None, d.diff(1.01, d.Near(1, atol=0.1)))
+    self.assertEqual("1 (rtol=1e-05, atol=1e-08)",
+                     d.diff(1.1, d.Near(1)).render_expected())
+    self.assertNotEqual(None, d.diff("1", d.Near(1)))
+
+    exact = dict(rtol=0, atol=0)
+    self.assertEqual(1, d.ulps_apart(1.0, 1.0000000000000002))
+    self.assertEqual(0, d.ulps_apart(-0.0, 0.0))
+    self.assertEqual(2, d.ulps_apart(-5e-324, 5e-324))
+    self.assertEqual(None, d.diff(1.0000000000000004,
+                                  d.Near(1.0, ulps=2, **exact)))
+    self.assertEqual("1.0 (rtol=0, atol=0, ulps=2)",
+                     d.diff(1.0000000000000007,
+                            d.Near(1.0, ulps=2, **exact)).render_expected())
+    self.assertNotEqual(None, d.diff(float("nan"),
+                                     d.Near(float("nan"), ulps=2, **exact)))
+
+    data = {"prices": [1.0000001, 2.0, {"tax": 3.3}], "count": 4}
+    template = {"prices": [1.0, 2.0, {"tax": 3.3000001}], "count": 4}
+    tolerance = {"rtol": 1e-6}
+    self.assertEqual("x['prices'][0]", d.diff(data, template).render_path())
+    self.assertEqual(None, d.diff(data, template, tolerance=tolerance))
+    self.assertTrue(d.matches(data, template, tolerance=tolerance))
+    self.assertEqual(None, d.compile(template, tolerance=tolerance).diff(data))
+    found = d.diff({"prices": [1.1, 2.0, {"tax": 3.3}], "count": 4},
+                   template, tolerance=tolerance)
+    self.assertEqual("x['prices'][0]", found.render_path())
+    self.assertEqual("1.0 (rtol=1e-06, atol=1e-08)", found.render_expected())
+    # only floats in the template are affected
+    self.assertEqual("x['count']",
+                     d.diff({"prices": data["prices"], "count": 4.0000001},
+                            template, tolerance=tolerance).render_path())
+
+    # infinities are only near themselves, like numpy.isclose()
+    inf = float("inf")
+    self.assertEqual(None, d.diff(inf, d.Near(inf)))
+    self.assertNotEqual(None, d.diff(-inf, d.Near(inf)))
+    self.assertNotEqual(None, d.diff(1e300, d.Near(inf)))
+    self.assertEqual(None, d.diff({"p": inf}, {"p": inf}, tolerance=tolerance))
+    self.assertEqual(None, d.diff([1.0, inf], d.ArrayNear([1.0, inf])))
+    self.assertEqual("x[1]",
+                     d.diff([1.0, 1e300], d.ArrayNear([1.0, inf])).render_path())
+
+    # and floats in sets
+    self.assertEqual(None, d.diff(set([1.0000001, 2]), set([1.0, 2]),
+                                  tolerance=tolerance))
+    self.assertTrue(d.matches([set([1.0000001])], [set([1.0])],
+                              tolerance=tolerance))
+    self.assertEqual(None, d.compile(d.Bag([[1.0], 2]), tolerance).diff(
+      [2, [1.0000001]]))
+    self.assertNotEqual(None, d.diff(set([1.1]), set([1.0]),
+                                     tolerance=tolerance))
+
+class WrapTest(unittest.TestCase):
+  def runTest(self):
+    c = d.Comparison()
+    for (item, comparator) in ((None, d.Equal),
+                               (b"x", d.Equal),
+                               (1j, d.Equal),
+                               (decimal.Decimal("1.5"), d.Equal),
+                               (datetime.datetime(2000, 1, 1), d.Equal),
+                               (range(3), d.Equal),
+                               (collections.OrderedDict(), d.Dict),
+                               (mess(), d.Object),
+                               (int, d.Is),
+                               ):
+      self.assertEqual(comparator, type(c.wrap(item)))
+
+    # these used to be compared as objects without a __dict__
+    self.assertNotEqual(None, d.diff(decimal.Decimal("1"),
+                                     decimal.Decimal("2")))
+    self.assertNotEqual(None, d.diff(datetime.date(2000, 1, 1),
+                                     datetime.date(2000, 1, 2)))
+    # and these without a __dict__ always differed
+    for (same, other, path) in (
+        (collections.deque([1]), collections.deque([2]), "x"),
+        (array.array("i", [1]), array.array("i", [2]), "x[0]"),
+        (re.compile("a"), re.compile("b"), "x")):
+      self.assertEqual(None, d.diff(same, copy.copy(same)))
+      self.assertEqual(path, d.diff(same, other).render_path())
+    numpy = d.numpy
+    if numpy is not None:
+      grid = numpy.array([[1, 2], [3, 4]])
+      self.assertEqual(d.ArrayEqual, type(c.wrap(grid)))
+      self.assertEqual(None, d.diff(grid, grid.copy()))
+      self.assertEqual("x[1][0]", d.diff(grid, numpy.array([[1, 2], [5, 4]])
+                                         ).render_path())
+      self.assertEqual(None, d.diff(numpy.float64(1), numpy.array(1.0)))
+
+    class Price(object):
+      def __init__(self, amount):
+        self.amount = amount
+    class Discount(Price):
+      pass
+
+    d.register_wrapper(Price, lambda item: d.Attrs(amount=item.amount))
+    try:
+      self.assertEqual(d.Attrs, type(c.wrap(Discount(1))))
+      self.assertEqual(None, d.diff(Discount(1), Price(1)))
+      self.assertEqual("x.amount", d.diff(Price(2), Discount(1)).render_path())
+    finally:
+      del d.WRAPPERS[Price]
+      d.WRAPPER_CACHE.clear()
+    self.assertEqual(d.Object, type(c.wrap(Discount(1))))
+
+class Slotted(object):
+  __slots__ = ("x", "__y")
+
+  def __init__(self, x, y):
+    self.x = x
+    self.__y = y
+
+class MoreSlotted(Slotted):
+  __slots__ = "z"
+
+  def __init__(self, x, y, z):
+    Slotted.__init__(self, x, y)
+    self.z = z
+
+class SlottedDict(Slotted):
+  pass
+
+Point = collections.namedtuple("Point", "x y")
+
+class Name(object):
+  """Has its own __eq__() and caches its lowercase form."""
+  __slots__ = ("name", "_lower")
+
+  def __init__(self, name):
+    self.name = name
+    self._lower = None
+
+  def lower(self):
+    if self._lower is None:
+      self._lower = self.name.lower()
+    return self._lower
+
+  def __eq__(self, other):
+    return isinstance(other, Name) and self.lower() == other.lower()
+
+  def __ne__(self, other):
+    return not self == other
+
+  __hash__ = object.__hash__
+
+class FieldsTest(unittest.TestCase):
+  def runTest(self):
+    self.assertEqual(("x", "_Slotted__y"), d.fields_of(Slotted))
+    self.assertEqual(("x", "_Slotted__y", "z"), d.fields_of(MoreSlotted))
+    self.assertEqual(("x", "_Slotted__y", "__dict__"),
+                     d.fields_of(SlottedDict))
+    self.assertEqual(("x", "y"), d.fields_of(Point))
+    self.assertEqual(None, d.fields_of(mess))
+
+    self.assertEqual(None, d.diff(Slotted(1, 2), Slotted(1, 2)))
+    self.assertEqual("x._Slotted__y",
+                     d.diff(Slotted(1, 2), Slotted(1, 3)).render_path())
+    self.assertEqual("x", d.diff(Slotted(1, 2), Point(1, 2)).render_path())
+    self.assertEqual(["x.x", "x._Slotted__y", "x.z"],
+                     [diff.render_path() for diff in
+                      d.iter_diffs(MoreSlotted(0, 0, 0), MoreSlotted(1, 2, 3))])
+    empty = Slotted.__new__(Slotted)
+    self.assertEqual("x.x", d.diff(empty, Slotted(1, 2)).render_path())
+    extra = SlottedDict(1, 2)
+    extra.w = 1
+    self.assertEqual("x.__dict__.keys() as a set (==)",
+                     d.diff(extra, SlottedDict(1, 2)).render_path())
+
+    self.assertEqual("x.y", d.diff(Point(1, 2), Point(1, 3)).render_path())
+    self.assertEqual("x", d.diff((1, 2), Point(1, 2)).render_path())
+    self.assertEqual(None, d.diff(Slotted(1, 2),
+                                  d.Fields(Slotted(1, 3), ["x"])))
+    self.assertEqual(None, d.compile([MoreSlotted(1, 2, 3)]).diff(
+      [MoreSlotted(1, 2, 3)]))
+    self.assertRaises(TypeError, d.Fields, datetime.date(2000, 1, 1))
+    self.assertEqual(None, d.diff(datetime.date(2000, 1, 2),
+                                  d.Fields(datetime.date(2000, 3, 2), ["day"])))
+
+    # slots with their own __eq__() may hold caches, so leave it to ==
+    name = Name("A")
+    name.lower()
+    self.assertEqual(d.Equal, type(d.Comparison().wrap(name)))
+    self.assertEqual(None, d.diff(name, Name("a")))
+    self.assertEqual("x", d.diff(name, Name("b")).render_path())
+    try:
+      import pathlib
+    except ImportError:
+      pass
+    else:
+      path = pathlib.Path("/a")
+      str(path)
+      self.assertEqual(None, d.diff(path, pathlib.Path("/a")))
+
+    try:
+      import dataclasses
+    except ImportError:
+      return
+
+    Data = dataclasses.make_dataclass("Data", [
+      "a", ("b", list, dataclasses.field(default_factory=list, compare=False))])
+
+    self.assertEqual(("a",), d.fields_of(Data))
+    self.assertEqual(None, d.diff(Data(1, [2]), Data(1, [3])))
+    self.assertEqual("x.a", d.diff(Data(1), Data(2)).render_path())
+
+class ReprTest(unittest.TestCase):
+  def runTest(self):
+    big = list(range(100000))
+    found = d.diff({"a": [big]}, {"a": ["y" * 100000]})
+    self.assertEqual("x['a'][0]", found.render_path())
+    self.assertTrue(len(found.render_full()) < 1000)
+    self.assertTrue(found.render_actual().startswith("[0, 1, 2, "))
+    self.assertTrue(found.render_actual().endswith(", ...]"))
+    # dicts keep their order
+    self.assertEqual("{'b': 2, 'a': 1}",
+                     d.diff({"b": 2, "a": 1}, 1).render_actual())
+
+    maxlist = d.REPR.maxlist
+    d.REPR.maxlist = 2
+    try:
+      self.assertEqual("[0, 1, ...]", d.diff(big, 1).render_actual())
+    finally:
+      d.REPR.maxlist = maxlist
+
+class StreamTest(unittest.TestCase):
+  def check(self, text, template):
+    try:
+      expected = d.diff(json.loads(text), template)
+    except d.DeepException as error:
+      expected = error
+    for source in (text, text.encode("utf-8")):
+      tokens = deep.stream.Tokens(source)
+      # make sure tokens are split across reads
+      tokens.chunk_size = 3
+      try:
+        found = deep.stream.Matcher(tokens).match(d.compile(template))
+      except d.DeepException as error:
+        self.assertTrue(isinstance(expected, d.DeepException), error)
+        self.assertEqual(expected.comp.render_path(), error.comp.render_path())
+        tokens.expect(None)
+        continue
+      self.assertFalse(isinstance(expected, d.DeepException), expected)
+      self.assertEqual(expected and expected.render_full(),
+                       found and found.render_full())
+
+  def runTest(self):
+    doc = {"id": 7, "name": "n\u00e9\"7\"", "tags": [1, 2.5, -3e5, None],
+           "blob": {"k": [list(range(5)), "]}"]}, "flags": [True, False]}
+    for text in (json.dumps(doc), json.dumps(doc, indent=1)):
+      self.check(text, doc)
+      self.check(text, {"id": 7, "name": d.Re("n"), "tags": [1, 2.5, -3e5],
+                        "blob": d.Ignore(), "flags": d.ArrayValues(True)})
+      self.check(text, {"id": 8, "name": d.Ignore(), "tags": d.Ignore(),
+                        "blob": {"k": d.DictValues(1)}, "flags": []})
+      self.check(text, {"id": d.Ignore(), "name": d.Ignore(),
+                        "tags": [1, 2.5, -3e5, 1], "blob": d.Ignore(),
+                        "flags": d.ArrayValues(d.Is(True))})
+      self.check(text, {"id": 7, "name": d.Ignore(), "tags": d.Ignore(),
+                        "blob": d.Ignore()})
+      self.check(text, {"id": 7, "name": d.Ignore(), "tags": d.Ignore(),
+                        "blob": d.Ignore(), "flags": d.Optional([True]),
+                        "more": d.Optional(1)})
+      self.check(text, {"id": d.Optional(8), "name": d.Ignore(),
+                        "tags": d.Ignore(), "blob": d.Ignore(),
+                        "more": d.Optional(1)})
+      self.check(text, {"id": 7, "name": d.Ignore(), "tags": d.Ignore(),
+                        "blob": {"k": [d.Ignore(), d.Ignore()]},
+                        "flags": d.And(d.Len(2), [True, True])})
+
+    # json.loads() keeps the last value for a key
+    for (text, template) in (('{"a": 1, "a": 2}', {"a": 2}),
+                             ('{"a": 2, "a": 1}', {"a": 2}),
+                             ('{"b": 1, "a": 1, "b": 2}', {"a": 1, "b": 2}),
+                             ('{"a": 1, "b": 1, "a": 2}', d.DictValues(2)),
+                             ('{"a": [1], "a": 2}', d.DictValues(2))):
+      self.check(text, template)
+
+    # a comparator that raises only wins if nothing before it differs
+    broken = d.IndexedElem(0, 1)
+    for (text, template) in (('{"a": 1, "b": 2}', {"a": broken}),
+                             ('{"b": 2, "a": 1}', {"a": broken, "b": 3}),
+                             ('{"b": 2, "a": 1}', {"a": 1, "b": broken}),
+                             ('[1, 2]', [broken]),
+                             ('[[1, 2], 3]', [[broken], 3]),
+                             ('[1, [2]]', [broken, [2]]),
+                             ('{"a": 1, "b": [2]}', d.DictValues(broken)),
+                             ('[[1], 2, [3]]', d.ArrayValues([broken]))):
+      self.check(text, template)
+
+    self.assertEqual(None, deep.stream.diff(json.dumps(doc), doc))
+    self.assertRaises(ValueError, deep.stream.diff, '{"a": 1} 2', {"a": 1})
+    self.assertRaises(ValueError, deep.stream.diff, '{"a": @}', {"a": 1})
+    self.assertRaises(ValueError, deep.stream.diff, '{"a": [1, 2', {"a": []})
+
+    records = "\n".join(json.dumps({"id": i, "v": [i, "x"]})
+                        for i in range(10))
+    found = deep.stream.diff_ndjson(io.BytesIO(records.encode("utf-8")),
+                                    {"id": d.InRange(0, 7),
+                                     "v": [d.Ignore(), "x"]})
+    self.assertEqual([(8, "x['id']"), (9, "x['id']")],
+                     [(n, diff.render_path()) for (n, diff) in found])
+
+class StatsTest(unittest.TestCase):
+  def runTest(self):
+    items = [{"id": i, "tags": [1, 2]} for i in range(10)]
+    comp = d.StatsComparison()
+    self.assertTrue(comp.descend(items, d.ArrayValues({"id": d.Ignore(),
+                                                       "tags": [1, 2]})))
+    self.assertEqual(10, comp.classes["Dict"][0])
+    self.assertEqual(10, comp.classes["Ignore"][0])
+    self.assertEqual(1, comp.classes["ArrayValues"][0])
+    # the IndexedElem and the Ignore
+    self.assertEqual(20, comp.paths["x[*]['id']"][0])
+    self.assertEqual(7, comp.max_depth)
+    for (count, total, own) in comp.paths.values():
+      self.assertTrue(total >= 0 and own >= 0)
+    self.assertEqual(comp.paths["x"][1], comp.frames[0][2])
+
+    summary = comp.summary(limit=2).split("\n")
+    self.assertEqual(7, len(summary))
+    self.assertTrue(summary[0].startswith("comparisons: "))
+
+    circ = [1]
+    circ.append(circ)
+    other = [1]
+    other.append(other)
+    comp = d.StatsComparison()
+    self.assertTrue(comp.descend(circ, other))
+    self.assertEqual(1, comp.cache.hits)
+
+    comp = d.StatsComparison()
+    self.assertFalse(comp.descend(items, d.ArrayValues({"id": 0,
+                                                        "tags": [1, 2]})))
+    self.assertEqual("x[1]['id']", comp.render_path())
+
+class ReTest(unittest.TestCase):
+  def runTest(self):
+    self.assertEqual(["x[1]", "something matching 'a'", "1"],
+                     [f(d.diff(["a", 1], [d.Re("a"), d.Re("a")])) for f in
+                      (d.Comparison.render_path, d.Comparison.render_expected,
+                       d.Comparison.render_actual)])
+    self.assertNotEqual(None, d.diff(None, d.Re("a")))
+    self.assertNotEqual(None, d.diff(b"abc", d.Re("a")))
+    self.assertEqual(None, d.diff(b"abc", d.Re(b"a")))
+    self.assertNotEqual(None, d.diff("abc", d.Re(b"a")))
+
+    self.assertEqual(None, d.diff("abc", d.Re("b")))
+    self.assertNotEqual(None, d.diff("abc", d.Re("b", mode="match")))
+    self.assertEqual(None, d.diff("abc", d.Re("a", mode="match")))
+    self.assertNotEqual(None, d.diff("abc", d.Re("ab", mode="fullmatch")))
+    found = d.diff("abc", d.Re("ab", mode="fullmatch"))
+    self.assertEqual("something matching 'ab' (fullmatch)",
+                     found.render_expected())
+    self.assertEqual(None, d.diff("abc", d.Re("a.c", mode="fullmatch")))
+
+    self.assertTrue(d.Re("shared").regex is d.Re("shared").regex)
+    self.assertFalse(d.Re("shared").regex is d.Re("shared", re.I).regex)
+
+    items = ["item %i" % i for i in range(100)] + [None, "x", "item 0"]
+    found = [diff.render_path() for diff in
+             d.iter_diffs(items, d.ArrayValues(d.Re(r"^item \d+$")))]
+    self.assertEqual(["x[100]", "x[101]"], found)
+
+class Broken(d.Composite):
+  def descents(self, item):
+    yield (item, 1)
+    raise ValueError("broken")
+
+  def expr(self, expr):
+    return "broken(%s)" % expr
+
+  def __repr__(self):
+    return "Broken()"
+
+class OnErrorTest(unittest.TestCase):
+  def runTest(self):
+    template = d.ArrayValues(d.IndexedElem("a", 1))
+    items = [{"a": 1}, {}, {"a": 2}, {"b": 1}]
+    self.assertRaises(d.DeepException, d.diff, items, template)
+    self.assertRaises(ValueError, d.Comparison, on_error="ignore")
+
+    found = d.diff(items, template, on_error="mismatch")
+    self.assertEqual("x[1]['a']", found.render_path())
+    self.assertEqual("no exception from IndexedElem('a')==1",
+                     found.render_expected())
+    self.assertEqual("KeyError: 'a', from {}", found.render_actual())
+    self.assertTrue(found.last()[1].error.__traceback__ is None)
+    self.assertEqual(["x[1]['a']", "x[2]['a']", "x[3]['a']"],
+                     [diff.render_path() for diff in
+                      d.iter_diffs(items, template, on_error="mismatch")])
+    self.assertFalse(d.matches(items, template, on_error="mismatch"))
+    self.assertNotEqual(None, d.diff(items, template, debug=True,
+                                     on_error="mismatch"))
+
+    found = d.diff([o], [d.CmpAttr("missing", 1)], on_error="mismatch")
+    self.assertEqual("x[0].missing", found.render_path())
+    self.assertTrue(found.render_actual().startswith("AttributeError"))
+
+    # a composite whose descents() raise is the one that fails
+    found = d.diff([1, 1], [Broken(), 1], on_error="mismatch")
+    self.assertEqual("broken(x[0])", found.render_path())
+    self.assertEqual("ValueError: broken, from 1", found.render_actual())
+
+    comp = d.Comparison(on_error="collect")
+    self.assertTrue(comp.descend([{}, {"a": 1}, [0]], template))
+    self.assertEqual(["x[0]['a']", "x[2]['a']"],
+                     [diff.render_path() for diff in comp.errors])
+    comp = d.Comparison(on_error="collect")
+    self.assertFalse(comp.descend([{}, {"a": 2}], template))
+    self.assertEqual("x[1]['a']", comp.render_path())
+    self.assertEqual(1, len(comp.errors))
+
+    # the entry points hand the errors back
+    found = d.diff([{}, {"a": 1}, [0]], template, on_error="collect")
+    self.assertEqual(["x[0]['a']", "x[2]['a']"],
+                     [diff.render_path() for diff in found.errors])
+    self.assertEqual("x[0]['a']", found.render_path())
+    self.assertEqual(None, d.diff([{"a": 1}], template, on_error="collect"))
+    self.assertEqual(["x[1]['a']", "x[2]['a']", "x[3]['a']"],
+                     [diff.render_path() for diff in
+                      d.iter_diffs(items, template, on_error="collect")])
+    self.assertEqual(["x[1]['a']"],
+                     [diff.render_path() for diff in
+                      d.iter_diffs(items, template, max_diffs=1,
+                                   on_error="collect")])
+    self.assertEqual(["broken(x[0])"],
+                     [diff.render_path() for diff in
+                      d.iter_diffs([1, 1], [Broken(), 1], on_error="collect")])
+    self.assertEqual(["x[0]['a']", None],
+                     [found and found.errors[0].render_path() for found in
+                      d.validate_many([[{}], [{"a": 1}]], template, workers=1,
+                                      on_error="collect")])
+    self.assertRaises(ValueError, d.matches, items, template,
+                      on_error="collect")
+    self.assertRaises(ValueError, d.Session, items, template,
+                      on_error="collect")
+
+    self.assertEqual("broken(x)",
+                     d.diff(1, Broken(), on_error="mismatch").render_path())
+
+class SlotsTest(unittest.TestCase):
+  def runTest(self):
+    import pickle
+
+    for c in (d.Equal(1), d.IndexedElem(0, 1), d.Len(1), d.InstanceOf(int),
+              d.CmpAttr("a", 1), d.HasAttr("a"), d.Slice([1], 0),
+              d.List([1]), d.Dict({}), d.Object(o), d.Attrs(a=1), d.And(1),
+              d.Re("a"), d.Near(1.0), d.Ignore(), d.Difference([])):
+      self.assertFalse(hasattr(c, "__dict__"), repr(c))
+
+    self.assertTrue(d.Ignore() is d.Ignore())
+    self.assertTrue(copy.copy(d.Ignore()) is d.Ignore())
+    self.assertTrue(d.instance_of(list) is d.instance_of(list))
+
+    # comparators without __slots__ still work
+    class Mine(d.Equal):
+      pass
+    mine = Mine(1)
+    mine.note = "anything"
+    self.assertEqual(None, d.diff(1, mine))
+
+    template = d.compile({"a": [1, d.Re("b")], "c": o2, "d": d.Attrs(an_attr=1),
+                          "e": d.Ignore()})
+    good = {"a": [1, "abc"], "c": o, "d": o, "e": None}
+    self.assertTrue(template.matches(good))
+    self.assertTrue(pickle.loads(pickle.dumps(template)).matches(good))
+    self.assertTrue(copy.deepcopy(template).matches(good))
+
+class ValidateManyTest(unittest.TestCase):
+  def runTest(self):
+    # a failure doesn't change the shared template, so an earlier one still
+    # renders what it found
+    template = d.EqSet([1, 2])
+    first = d.diff(set([1, 3]), template)
+    second = d.diff(set([2, 4]), template)
+    self.assertEqual("1 matching element(s), extra: [3], missing: [2]",
+                     first.render_actual())
+    self.assertEqual("1 matching element(s), extra: [4], missing: [1]",
+                     second.render_actual())
+    self.assertEqual("x as a set (==)", first.render_path())
+    self.assertEqual("2 matching element(s)", first.render_expected())
+
+    # a result from the cache is worked out again
+    s = set([1, 3])
+    found = list(d.iter_diffs([s, s], [template, template]))
+    self.assertEqual([first.render_actual()] * 2,
+                     [diff.render_actual() for diff in found])
+
+    template = {"id": d.InstanceOf(int), "tags": d.Set([1, 2])}
+    items = [{"id": i, "tags": set([1, i % 5])} for i in range(200)]
+    results = d.validate_many(items, template, workers=4)
+    self.assertEqual(200, len(results))
+    for (i, found) in enumerate(results):
+      if i % 5 == 2:
+        self.assertEqual(None, found)
+      else:
+        extra = [i % 5] if i % 5 != 1 else []
+        self.assertEqual(
+          "1 matching element(s), extra: %s, missing: [2]" % extra,
+          found.render_actual())
+
+    pool = multiprocessing.pool.ThreadPool(2)
+    try:
+      self.assertEqual([None, None],
+                       d.validate_many([1.0, 1.05], 1.0, pool=pool,
+                                       tolerance={"atol": 0.1}))
+    finally:
+      pool.terminate()
+
+class Counted(d.Equal):
+  """Counts the comparisons made."""
+  calls = 0
+
+  def equals(self, item, comp):
+    Counted.calls += 1
+    return d.Equal.equals(self, item, comp)
+
+class SessionTest(unittest.TestCase):
+  def check(self, session, changed, calls=None):
+    Counted.calls = 0
+    found = session.update(changed)
+    if calls is not None:
+      self.assertEqual(calls, Counted.calls)
+    expected = d.diff(session.item, session.template)
+    if expected is None:
+      self.assertEqual(None, found)
+    else:
+      self.assertEqual(expected.render_full(), found.render_full())
+
+  def runTest(self):
+    state = {"users": [{"name": "u%i" % i, "tags": [1]} for i in range(100)],
+             "owner": mess(), "n": 1}
+    template = {"users": d.ArrayValues({"name": d.Re("^u"),
+                                        "tags": Counted([1])}),
+                "owner": d.Attrs(an_attr=1, an_attr2=Counted(2)),
+                "n": d.InRange(0, 10)}
+    session = d.Session(state, template)
+    Counted.calls = 0
+    self.assertEqual(None, session.check())
+    self.assertEqual(101, Counted.calls)
+
+    state["users"][3]["name"] = 5
+    self.check(session, [("users", 3, "name")], 0)
+    state["users"][3]["name"] = "u"
+    state["users"][5]["tags"] = [2]
+    self.check(session, [("users", 3, "name"), ("users", 5, "tags")], 1)
+    # the difference is remembered too
+    state["n"] = 2
+    self.check(session, [("n",)], 0)
+
+    state["users"][5]["tags"] = [1]
+    state["users"].append({"name": "u", "tags": [1]})
+    self.check(session, [("users", 5), ("users", 100)], 2)
+    del state["users"][0]
+    self.check(session, [("users",)], 100)
+
+    state["owner"].an_attr2 = 3
+    self.check(session, [("owner", "an_attr2")], 1)
+    state["owner"] = mess()
+    self.check(session, [("owner",)], 1)
+
+    state["users"] = []
+    self.check(session, [()], 1)
+
+    # the elements of a set have no paths
+    state = {"s": set([1, 2]), "t": [1]}
+    session = d.Session(state, {"s": d.EqSet([1, 2]), "t": [1]})
+    self.assertEqual(None, session.check())
+    state["s"].add(3)
+    self.check(session, [("s", 3)])
+
+    # Optional compares the value at the same path
+    state = {"a": [1], "b": [2]}
+    session = d.Session(state, {"a": [1], "b": d.Optional([Counted(2)])})
+    self.assertEqual(None, session.check())
+    state["b"][0] = 3
+    self.check(session, [("b", 0)], 1)
+    del state["b"]
+    self.check(session, [("b",)], 0)
+
+Point3 = collections.namedtuple("Point3", "x y z")
+
+class Tags(list):
+  """A list with an attribute."""
+
+class DumpTest(unittest.TestCase):
+  def runTest(self):
+    template = {
+      "a": [1, d.Re("b", re.I, mode="match")], "o": o2, "p": Point3(1, 2, 3),
+      (1, None): b"xy", "types": d.InstanceOf((int, type(None))),
+      "set": d.Set([1, d.Ignore()]), "bag": d.Bag([1, 1]),
+      "near": d.Near(1.0, ulps=4), "range": d.InRange(1, 5),
+      "attrs": d.Attrs(an_attr=1), "call": d.Call(1, [2], {"x": 3}),
+      "and": d.And(1, d.Type(int)), "values": d.ArrayValues({"k": d.Len(2)}),
+      "dict": d.DictValues(1), "keys": d.HasKeys(["a"]),
+      "fields": d.Fields(Point3(1, 2, 3)), "is": d.Is(int),
+      "array": d.ArrayNear([1.0, 2.0]), "slice": d.Slice(1, [0]),
+      "object": d.Object(o2), "attr": d.Attr("an_attr", 1),
+      "misc": [1 + 2j, decimal.Decimal("1.5"), datetime.date(2020, 1, 2),
+               datetime.timedelta(3), d.ArrayEqual(array.array("i", [1])),
+               frozenset([1]), (1, 2)],
+      }
+    text = d.dumps(template)
+    json.loads(text)
+    # loading compiles the template
+    loaded = d.loads(text)
+    compiled = d.dumps(d.compile(template))
+    self.assertEqual(compiled, d.dumps(loaded))
+    self.assertEqual(compiled, d.dumps(d.loads(compiled)))
+    out = io.StringIO()
+    d.dump(template, out)
+    self.assertEqual(compiled, d.dumps(d.load(io.StringIO(out.getvalue()))))
+
+    good = {
+      "a": [1, "Bc"], "o": o, "p": Point3(1, 2, 3), (1, None): b"xy",
+      "types": None, "set": set([1, "x"]), "bag": [1, 1], "near": 1.0,
+      "range": 3, "attrs": o, "call": lambda y, x: y + x - 4, "and": 1,
+      "values": [{"k": "ab"}], "dict": {"q": 1}, "keys": {"a": 0},
+      "fields": Point3(1, 2, 3), "is": int, "array": [1.0, 2.0],
+      "slice": [1], "object": o, "attr": o,
+      "misc": [1 + 2j, decimal.Decimal("1.5"), datetime.date(2020, 1, 2),
+               datetime.timedelta(3), array.array("i", [1]), frozenset([1]),
+               (1, 2)],
+      }
+    self.assertEqual(None, d.diff(good, template))
+    self.assertEqual(None, d.diff(good, loaded))
+    for (key, value) in (("a", [1, "cb"]), ("o", noto), ("types", 1.0),
+                         ("p", Point3(1, 2, 4)), ("near", 1.1)):
+      bad = dict(good)
+      bad[key] = value
+      self.assertEqual(d.diff(bad, template).render_full(),
+                       d.diff(bad, loaded).render_full())
+
+    self.assertRaises(TypeError, d.dumps, d.Is(o))
+    self.assertRaises(TypeError, d.dumps, d.Raised(d.Equal(1), KeyError()))
+    circ = [1]
+    circ.append(circ)
+    self.assertRaises(ValueError, d.dumps, circ)
+    # shared parts are fine
+    self.assertEqual('[[1],[1]]', d.dumps([[1]] * 2))
+    self.assertRaises(TypeError, d.loads, '{"Exception":[]}')
+
+    # subclasses of the builtin containers keep their items
+    tags = Tags(["a", "b"])
+    tags.source = "x"
+    for value in (collections.OrderedDict([("b", 1), ("a", 2)]),
+                  collections.Counter("abb"), tags):
+      loaded = d.loads(d.dumps(value)).value
+      self.assertEqual(type(value), type(loaded))
+      self.assertEqual(list(value.items() if hasattr(value, "items")
+                            else value),
+                       list(loaded.items() if hasattr(loaded, "items")
+                            else loaded))
+    self.assertEqual("x", d.loads(d.dumps(tags)).value.source)
+    self.assertEqual("x['a']", d.diff(collections.OrderedDict([("a", 1)]),
+                                      d.loads(d.dumps({"a": 2}))).render_path())
+
+    # these can't be rebuilt when loaded
+    class Local(object):
+      pass
+    for value in (d.Call(1, [lambda: 1]), [len], Local(), Local, [str.upper]):
+      self.assertRaises(TypeError, d.dumps, value)
+
+class InferTest(unittest.TestCase):
+  def runTest(self):
+    sample = {"users": [{"id": 1, "name": "a", "email": None, "score": 1.5},
+                        {"id": 2, "name": "b", "email": "b@x", "score": 2}],
+              "tags": [], "point": (1.0, "x"), "owner": o}
+    template = d.infer(sample)
+    self.assertEqual(None, d.diff(sample, template))
+    self.assertEqual(d.dumps(template),
+                     d.dumps(d.infer(d.loads(d.dumps(sample)).value)))
+
+    other = {"users": [{"id": 7, "name": "c", "email": "c@x", "score": 3}],
+             "tags": [1, 2], "point": (2.0, "y"), "owner": o2}
+    self.assertEqual(None, d.diff(other, template))
+
+    other["users"].append({"id": "8", "name": "d", "email": None,
+                           "score": 0})
+    found = d.diff(other, template)
+    self.assertEqual("x['users'][1]['id']", found.render_path())
+    self.assertEqual("instance of <class 'int'>", found.render_expected())
+
+    other["users"].pop()
+    other["owner"] = noto
+    self.assertEqual(None, d.diff(other, template))
+    other["owner"].an_attr2 = "7"
+    self.assertEqual("x['owner'].an_attr2", d.diff(other, template).render_path())
+    other["owner"].an_attr2 = 7
+
+    # keys that only some of the dicts have are Optional
+    template = d.infer([{"id": 1}, {"id": 2, "email": "a", "x": [1.5]},
+                        {"id": 3, "email": None}])
+    self.assertEqual(d.Optional, type(template.conds[1].value["email"]))
+    self.assertEqual(None, d.diff([{"id": 4, "x": []}, {"id": 5}], template))
+    self.assertEqual("x[0]['email']",
+                     d.diff([{"id": 4, "email": 5}], template).render_path())
+    self.assertEqual("x[0].keys() as a set (==)",
+                     d.diff([{"email": "b"}], template).render_path())
+    self.assertEqual(None, d.diff([{"id": 4}],
+                                  d.loads(d.dumps(template))))
+
+    # elements that don't fit together are only compared by type
+    template = d.infer([{"a": 1}, {"b": 2}, [1], 5])
+    self.assertEqual(None, d.diff([{}, [], 1], template))
+    self.assertNotEqual(None, d.diff(["x"], template))
+
 
 if __name__ == '__main__':
   suite = unittest.TestSuite()
   suite.addTests([ DeepTest(),
                    DeepExc(),
+                   CompileTest(),
+                   MatchesTest(),
+                   DictTest(),
+                   AttrsTest(),
+                   BagTest(),
+                   FingerprintTest(),
+                   DeepNestingTest(),
+                   IterDiffsTest(),
+                   CacheTest(),
+                   ParallelDiffTest(),
+                   ArrayTest(),
+                   NearTest(),
+                   WrapTest(),
+                   FieldsTest(),
+                   ReprTest(),
+                   StreamTest(),
+                   StatsTest(),
+                   ReTest(),
+                   OnErrorTest(),
+                   SlotsTest(),
+                   ValidateManyTest(),
+                   SessionTest(),
+                   DumpTest(),
+                   InferTest(),
                   ]
                 )
   unittest.TextTestRunner(verbosity=3).run(suite)